@@ -0,0 +1,97 @@
+"""Local cache of the last verified revision of each image."""
+
+import fcntl
+import os
+import shutil
+import tempfile
+
+from oslo_config import cfg
+from oslo_log import log
+
+opts = [
+    cfg.StrOpt(
+        "cache_dir",
+        help="Directory where the last verified revision of each image that "
+        "can be delta synced (see delta_sync) is kept, so that it can be reused "
+        "for delta updates. If not set, no image is kept after being synced.",
+    ),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
+LOG = log.getLogger(__name__)
+
+# ioctl to share the extents of a file (reflink) in btrfs, XFS...
+FICLONE = 0x40049409
+
+
+def get_path(distro, filename):
+    """Get the path of a cached image.
+
+    :param distro: name of the distribution
+    :param filename: upstream file name of the image
+    :returns: the path of the cached image or None if it is not cached
+    """
+    if not CONF.cache_dir:
+        return None
+    path = os.path.join(CONF.cache_dir, distro, filename)
+    if not os.path.isfile(path):
+        return None
+    return path
+
+
+def _reflink(src, dst):
+    """Create dst as a reflink (copy on write clone) of src."""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+
+
+def link_or_copy(src, dst):
+    """Hardlink a file, falling back to a reflink or to a copy.
+
+    Hardlinks only work in the same filesystem, and reflinks only in
+    filesystems that support them, so the data is only copied as a last resort.
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError as e:
+        LOG.debug("Cannot link %s into %s (%s), trying a reflink", src, dst, e)
+    try:
+        _reflink(src, dst)
+    except OSError as e:
+        LOG.debug("Cannot reflink %s into %s (%s), copying it", src, dst, e)
+        shutil.copyfile(src, dst)
+
+
+def store(path, distro, filename):
+    """Keep a verified image in the cache, replacing the previous revision.
+
+    :param path: path of the verified image
+    :param distro: name of the distribution
+    :param filename: upstream file name of the image
+    """
+    if not CONF.cache_dir:
+        return
+
+    directory = os.path.join(CONF.cache_dir, distro)
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".", suffix=".imgsync")
+    os.close(fd)
+    os.remove(tmp)
+    try:
+        link_or_copy(path, tmp)
+        os.replace(tmp, os.path.join(directory, filename))
+    except OSError as e:
+        LOG.warning("Cannot store %s in the cache: %s", filename, e)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return
+    LOG.debug("Cached %s for %s", filename, distro)
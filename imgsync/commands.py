@@ -16,12 +16,16 @@
 
 from __future__ import print_function
 
+import argparse
+import datetime
+import json
 import sys
 
 from oslo_config import cfg
 
 from imgsync import distros
 from imgsync import exception
+from imgsync import profiling
 
 CONF = cfg.CONF
 
@@ -29,6 +33,7 @@ CONF = cfg.CONF
 def add_command_parsers(subparsers):
     """Add command parsers to the global parser."""
     SyncCommand(subparsers)
+    PlanCommand(subparsers)
 
 
 command_opt = cfg.SubCommandOpt(
@@ -62,11 +67,117 @@ class SyncCommand(Command):
     def __init__(self, parser, name="sync", cmd_help="Syncrhonize configured images"):
         """Initialize the sync command."""
         super(SyncCommand, self).__init__(parser, name, cmd_help)
-        self.manager = distros.DistroManager()
 
     def run(self):
         """Run the sync command."""
-        self.manager.sync()
+        # NOTE: the manager is created here, as the configuration files have
+        # not been parsed yet when the command parsers are built.
+        distros.DistroManager().sync()
+
+
+def _format_size(size):
+    """Format a size in bytes in a human readable way."""
+    if size is None:
+        return "?"
+    units = ["B", "KiB", "MiB", "GiB", "TiB"]
+    unit = units.pop(0)
+    while size >= 1024 and units:
+        size /= 1024.0
+        unit = units.pop(0)
+    return "%.1f %s" % (size, unit)
+
+
+def _positive_float(value):
+    """Parse a command line argument that has to be a positive number."""
+    try:
+        value = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid number: %s" % value)
+    if value <= 0:
+        raise argparse.ArgumentTypeError("must be greater than 0: %s" % value)
+    return value
+
+
+class PlanCommand(Command):
+    """Plan command."""
+
+    def __init__(
+        self,
+        parser,
+        name="plan",
+        cmd_help="Show what would be synced, without transferring any image",
+    ):
+        """Initialize the plan command."""
+        super(PlanCommand, self).__init__(parser, name, cmd_help)
+        self.parser.add_argument(
+            "--json",
+            action="store_true",
+            default=False,
+            help="Print the plan as JSON.",
+        )
+        self.parser.add_argument(
+            "--bandwidth",
+            type=_positive_float,
+            default=100.0,
+            help="Download bandwidth, in Mbit/s, used to estimate the time "
+            "needed to sync the images (default: 100).",
+        )
+
+    def _summarize(self, plan):
+        """Get the totals of a plan."""
+        summary = {
+            action: len([i for i in plan if i["action"] == action])
+            for action in ("create", "update", "skip", "download", "error")
+        }
+
+        # Images are downloaded once and then uploaded to all the targets.
+        downloads = {
+            i["url"]: i["size"] or 0
+            for i in plan
+            if i["action"] in ("create", "download")
+        }
+        summary["download_bytes"] = sum(downloads.values())
+        summary["upload_bytes"] = sum(
+            i["size"] or 0 for i in plan if i["action"] == "create"
+        )
+        summary["estimated_seconds"] = round(
+            summary["download_bytes"] * 8 / (CONF.command.bandwidth * 10**6)
+        )
+        return summary
+
+    def run(self):
+        """Run the plan command."""
+        plan = distros.DistroManager().plan()
+        summary = self._summarize(plan)
+
+        if CONF.command.json:
+            print(json.dumps({"images": plan, "summary": summary}, indent=4))
+            return
+
+        for i in plan:
+            print(
+                "%-8s %-12s %-12s %10s  %s"
+                % (
+                    i["action"],
+                    i["distro"],
+                    i["target"] or "-",
+                    _format_size(i["size"]),
+                    i["name"] or "-",
+                )
+            )
+        print(
+            "\n%(create)s to create, %(update)s to update, %(skip)s to skip, "
+            "%(download)s to download only, %(error)s errors." % summary
+        )
+        print(
+            "%s to download, %s to upload, estimated time %s at %s Mbit/s."
+            % (
+                _format_size(summary["download_bytes"]),
+                _format_size(summary["upload_bytes"]),
+                datetime.timedelta(seconds=summary["estimated_seconds"]),
+                CONF.command.bandwidth,
+            )
+        )
 
 
 class CommandManager(object):
@@ -75,7 +186,10 @@ class CommandManager(object):
     def execute(self):
         """Execute the command."""
         try:
-            CONF.command.func()
+            if CONF.profile:
+                profiling.run(CONF.command.func)
+            else:
+                CONF.command.func()
         except exception.ImgSyncException as e:
             print("ERROR: %s" % e, file=sys.stderr)
             sys.exit(1)
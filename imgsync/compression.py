@@ -0,0 +1,146 @@
+"""Stream decompression of compressed upstream artifacts."""
+
+import bz2
+import lzma
+import os
+import shutil
+import tarfile
+import zlib
+
+from oslo_log import log
+
+from imgsync import exception
+
+LOG = log.getLogger(__name__)
+
+BLOCK_SIZE = 2**20
+_INPUT_BLOCK_SIZE = 2**16
+
+_DECOMPRESSORS = {
+    "bz2": bz2.BZ2Decompressor,
+    "gz": lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    "xz": lzma.LZMADecompressor,
+}
+
+SUPPORTED_COMPRESSIONS = sorted(_DECOMPRESSORS)
+
+
+class HashingReader(object):
+    """File-like object over an iterator of blocks that hashes what it reads.
+
+    Every byte that is returned by :meth:`read` is fed into the given hash
+    objects, so that the checksum of the compressed artifact is computed in the
+    same pass that decompresses it.
+    """
+
+    def __init__(self, blocks, *hashes):
+        """Initialize the reader.
+
+        :param blocks: iterator yielding blocks of bytes
+        :param hashes: hash objects to update with the data being read
+        """
+        self._blocks = iter(blocks)
+        self._hashes = hashes
+        self._buffer = b""
+        self.bytes_read = 0
+
+    def _update(self, data):
+        for h in self._hashes:
+            h.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def read(self, size=-1):
+        """Read up to size bytes, or everything if size is negative."""
+        if size is None or size < 0:
+            data = self._buffer + b"".join(self._blocks)
+            self._buffer = b""
+            return self._update(data)
+
+        while len(self._buffer) < size:
+            try:
+                block = next(self._blocks)
+            except StopIteration:
+                break
+            self._buffer += block
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return self._update(data)
+
+    def drain(self, block_size=BLOCK_SIZE):
+        """Read, and hash, any data that has not been consumed yet."""
+        while self.read(block_size):
+            pass
+
+
+def _decompress_block(decompressor, data, max_length):
+    """Decompress a block, yielding at most max_length bytes at a time."""
+    if hasattr(decompressor, "unconsumed_tail"):
+        # zlib keeps the input that it has not consumed yet apart
+        while data:
+            yield decompressor.decompress(data, max_length)
+            data = decompressor.unconsumed_tail
+    else:
+        # bz2 and lzma keep it buffered internally
+        yield decompressor.decompress(data, max_length)
+        while not (decompressor.needs_input or decompressor.eof):
+            yield decompressor.decompress(b"", max_length)
+
+
+def _decompress_stream(reader, fd, compression, block_size):
+    decompressor = _DECOMPRESSORS[compression]()
+    # Sparse disk images can have huge compression ratios, so the output of
+    # each call is limited, not to hold the decompressed data in memory.
+    buf = reader.read(_INPUT_BLOCK_SIZE)
+    while buf:
+        for data in _decompress_block(decompressor, buf, block_size):
+            if data:
+                fd.write(data)
+        buf = reader.read(_INPUT_BLOCK_SIZE)
+    if hasattr(decompressor, "flush"):
+        fd.write(decompressor.flush())
+
+
+def _extract_member(reader, fd, compression, member, block_size):
+    with tarfile.open(fileobj=reader, mode="r|%s" % compression) as tar:
+        for info in tar:
+            if info.isfile() and os.path.normpath(info.name) == member:
+                shutil.copyfileobj(tar.extractfile(info), fd, block_size)
+                return
+    raise exception.ImageDecompressionFailed(
+        reason="member %s not found in archive" % member
+    )
+
+
+def decompress(reader, fd, compression, member=None, block_size=BLOCK_SIZE):
+    """Decompress a compressed stream into a file object.
+
+    Nothing but the decompressed data is written to disk. Once decompressed,
+    the rest of the stream is consumed so that a :class:`HashingReader` gets
+    the checksum of the whole compressed artifact.
+
+    :param reader: file-like object with the compressed data
+    :param fd: file object where the decompressed data is written
+    :param compression: compression of the stream, one of
+                        ``SUPPORTED_COMPRESSIONS``
+    :param member: if set, the stream is a compressed tarball and only the
+                   member with this name is written
+    :param block_size: block size to use when reading the stream
+    """
+    if compression not in _DECOMPRESSORS:
+        raise exception.ImageDecompressionFailed(
+            reason="unsupported compression %s" % compression
+        )
+
+    LOG.debug("Decompressing %s stream", compression)
+    try:
+        if member:
+            _extract_member(reader, fd, compression, member, block_size)
+        else:
+            _decompress_stream(reader, fd, compression, block_size)
+    except (EOFError, OSError, lzma.LZMAError, tarfile.TarError, zlib.error) as e:
+        raise exception.ImageDecompressionFailed(reason=e)
+
+    drain = getattr(reader, "drain", None)
+    if drain is not None:
+        drain(block_size)
@@ -0,0 +1,222 @@
+"""Delta updates of images using zsync control files.
+
+Upstream repositories (e.g. Ubuntu cloud images) publish a ``.zsync`` control
+file next to each image, with a weak (rsum) and a strong (MD4) checksum for
+every block of the file. We build an index of the blocks of the previous
+revision that we have in the cache, and we only fetch with HTTP Range requests
+the blocks of the new revision that cannot be found in it.
+
+Only the block-aligned positions of the previous revision are indexed, as
+rolling the weak checksum over every byte offset in Python is slower than
+downloading the image. Disk images are laid out in aligned clusters, so this
+finds most of the unchanged data.
+"""
+
+import itertools
+
+from oslo_config import cfg
+from oslo_log import log
+import requests
+
+from imgsync import exception
+from imgsync import hashing
+
+opts = [
+    cfg.BoolOpt(
+        "delta_sync",
+        default=False,
+        help="Try to download only the changed blocks of an image, reusing "
+        "the previous revision stored in the cache_dir directory. This needs "
+        "the upstream repository to publish zsync control files (currently "
+        "Ubuntu) and MD4 to be available in hashlib (with OpenSSL 3 it needs "
+        "the legacy provider). If it is not possible, the whole image is "
+        "downloaded.",
+    ),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
+LOG = log.getLogger(__name__)
+
+# Missing runs that are closer than this number of blocks are fetched in the
+# same range request, to avoid doing lots of tiny requests.
+MERGE_GAP = 16
+
+
+class ControlFile(object):
+    """A parsed zsync control file."""
+
+    def __init__(self, data):
+        """Parse the zsync control file contents.
+
+        :param data: bytes of the control file
+        """
+        try:
+            header, _, body = data.partition(b"\n\n")
+            self.headers = {}
+            for line in header.decode("utf-8").splitlines():
+                key, _, value = line.partition(":")
+                self.headers[key.strip()] = value.strip()
+
+            self.blocksize = int(self.headers["Blocksize"])
+            self.length = int(self.headers["Length"])
+            seq_matches, rsum_bytes, checksum_bytes = (
+                int(i) for i in self.headers["Hash-Lengths"].split(",")
+            )
+        except (KeyError, ValueError) as e:
+            raise exception.DeltaSyncFailed(reason="wrong control file (%s)" % e)
+
+        self.seq_matches = seq_matches
+        self.rsum_bytes = rsum_bytes
+        self.checksum_bytes = checksum_bytes
+        self.rsum_mask = (1 << (8 * rsum_bytes)) - 1
+
+        nblocks = (self.length + self.blocksize - 1) // self.blocksize
+        entry = rsum_bytes + checksum_bytes
+        if len(body) < nblocks * entry:
+            raise exception.DeltaSyncFailed(reason="truncated control file")
+
+        self.blocks = []
+        for start in range(0, nblocks * entry, entry):
+            end = start + entry
+            raw = body[start:end]
+            rsum = int.from_bytes(raw[:rsum_bytes], "big")
+            self.blocks.append((rsum, raw[rsum_bytes:]))
+
+
+def rsum(block):
+    """Get the zsync weak checksum of a block, as a 32 bit integer."""
+    a = sum(block) & 0xFFFF
+    b = sum(itertools.accumulate(block)) & 0xFFFF
+    return (a << 16) | b
+
+
+def md4(data):
+    """Get the MD4 digest of a block (the zsync strong checksum)."""
+    return hashing.new("md4", data).digest()
+
+
+def _has_md4():
+    try:
+        hashing.new("md4")
+    except ValueError:
+        return False
+    return True
+
+
+# OpenSSL 3 only provides MD4 with its legacy provider. Computing it in pure
+# Python is slower than downloading the whole image, so delta updates are not
+# done without it.
+MD4_AVAILABLE = _has_md4()
+
+
+def build_index(path, control):
+    """Index the blocks of a local file that are present in the new file.
+
+    :param path: path of the previous revision of the file
+    :param control: ControlFile of the new revision
+    :returns: dict mapping (rsum, strong checksum) to offsets in the file
+    """
+    wanted = {r for r, _ in control.blocks}
+    index = {}
+    blocksize = control.blocksize
+    with open(path, "rb") as f:
+        offset = 0
+        block = f.read(blocksize)
+        while block:
+            block = block.ljust(blocksize, b"\x00")
+            weak = rsum(block) & control.rsum_mask
+            if weak in wanted:
+                strong = md4(block)[: control.checksum_bytes]
+                index.setdefault((weak, strong), offset)
+            offset += blocksize
+            block = f.read(blocksize)
+    return index
+
+
+def _missing_runs(missing):
+    """Group missing block numbers into (first, last) runs to fetch."""
+    runs = []
+    for i in missing:
+        if runs and i - runs[-1][1] <= MERGE_GAP:
+            runs[-1][1] = i
+        else:
+            runs.append([i, i])
+    return runs
+
+
+def fetch(url, control_url, old_path, location, timeout=10):
+    """Download a file reusing the blocks of a previous revision.
+
+    :param url: url of the new revision of the file
+    :param control_url: url of the zsync control file of the new revision
+    :param old_path: path of the previous revision of the file
+    :param location: file object where the new revision is written
+    :returns: number of bytes downloaded from url
+    """
+    if not MD4_AVAILABLE:
+        raise exception.DeltaSyncFailed(reason="MD4 is not available in hashlib")
+
+    session = requests.Session()
+    try:
+        response = session.get(control_url, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        raise exception.DeltaSyncFailed(reason=e)
+    if response.status_code != 200:
+        raise exception.DeltaSyncFailed(
+            reason="cannot get %s (%s)" % (control_url, response.status_code)
+        )
+    control = ControlFile(response.content)
+
+    try:
+        return _fetch_blocks(session, url, control, old_path, location, timeout)
+    except (requests.exceptions.RequestException, OSError) as e:
+        # e.g. a dropped connection while reading a range, or a full disk
+        raise exception.DeltaSyncFailed(reason=e)
+
+
+def _fetch_blocks(session, url, control, old_path, location, timeout):
+    """Write the new revision, downloading the blocks not found locally."""
+    index = build_index(old_path, control)
+    blocksize = control.blocksize
+    sources = [index.get(block) for block in control.blocks]
+    missing = [i for i, source in enumerate(sources) if source is None]
+    LOG.info(
+        "Reusing %s of %s blocks from previous revision of %s",
+        len(sources) - len(missing),
+        len(sources),
+        url,
+    )
+
+    runs = _missing_runs(missing)
+    downloaded = 0
+    with open(old_path, "rb") as old:
+        current = 0
+        for first, last in runs + [[len(sources), None]]:
+            for i in range(current, first):
+                if sources[i] is None:
+                    continue
+                old.seek(sources[i])
+                location.seek(i * blocksize)
+                location.write(old.read(blocksize).ljust(blocksize, b"\x00"))
+            if last is None:
+                break
+
+            start = first * blocksize
+            end = min((last + 1) * blocksize, control.length) - 1
+            headers = {"Range": "bytes=%s-%s" % (start, end)}
+            response = session.get(url, headers=headers, stream=True, timeout=timeout)
+            if response.status_code != 206:
+                raise exception.DeltaSyncFailed(
+                    reason="range requests not supported (%s)" % response.status_code
+                )
+            location.seek(start)
+            for chunk in response.iter_content(2**16):
+                location.write(chunk)
+                downloaded += len(chunk)
+            current = last + 1
+
+    location.truncate(control.length)
+    location.flush()
+    return downloaded
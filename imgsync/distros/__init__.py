@@ -14,11 +14,14 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from concurrent import futures
 import itertools
 
 from oslo_config import cfg
 from oslo_log import log
 
+from imgsync import exception
+from imgsync import profiling
 from imgsync.distros import debian
 from imgsync.distros import ubuntu
 
@@ -55,6 +58,23 @@ opts = [
         help="List of distributions to sync (supported values are "
         "%s)." % ", ".join(SUPPORTED_DISTROS),
     ),
+    cfg.BoolOpt(
+        "fetch_compressed",
+        default=False,
+        help="Download the compressed artifact of the images, when the "
+        "distribution publishes one (currently Debian, that publishes raw disk "
+        "images as tar.xz), decompressing it on the fly. This reduces the data "
+        "transferred from the upstream repositories, but the decompressed "
+        "images may be larger than the uncompressed qcow2 ones.",
+    ),
+    cfg.IntOpt(
+        "sync_workers",
+        default=1,
+        min=1,
+        help="Number of distributions to sync concurrently. Downloads that do "
+        "not fit in the staging directory are queued until there is enough "
+        "space for them.",
+    ),
 ]
 
 cli_opts = [
@@ -64,7 +84,8 @@ cli_opts = [
         help="Only download the images, do not sync them to glance. Be aware"
         " that images are deleted after being synced to glance, so if you use"
         " this option the images will be deleted after the download. Use this"
-        " only for debugging purposes.",
+        " only for debugging purposes, or with mirror_dir, to only download"
+        " the images that are not in the mirror yet.",
     ),
     cfg.BoolOpt(
         "dry-run",
@@ -102,6 +123,44 @@ class DistroManager(object):
         if CONF.dry_run:
             LOG.warn("Dry run, not syncing the images to glance.")
 
-        for distro in self.distros:
-            LOG.info("Syncing %s", distro.name)
-            distro.sync()
+        if CONF.sync_workers == 1:
+            results = [self._sync_one(distro) for distro in self.distros]
+        else:
+            with futures.ThreadPoolExecutor(max_workers=CONF.sync_workers) as executor:
+                results = list(executor.map(self._sync_one, self.distros))
+
+        failed = [d.name for d, ok in zip(self.distros, results) if not ok]
+        if failed:
+            raise exception.DistroSyncFailed(distros=", ".join(failed))
+
+    def plan(self):
+        """Plan the sync of the distributions, without transferring images.
+
+        Upstream manifests and Glance catalogs are queried concurrently.
+
+        :returns: list of dicts with the planned action for each image
+        """
+        with futures.ThreadPoolExecutor(max_workers=len(self.distros) or 1) as executor:
+            plans = executor.map(self._plan_one, self.distros)
+            return list(itertools.chain.from_iterable(plans))
+
+    def _plan_one(self, distro):
+        """Plan the sync of one distribution."""
+        with profiling.phase("plan", distro.name):
+            return distro.plan()
+
+    def _sync_one(self, distro):
+        """Sync one distribution.
+
+        Errors are logged, so that they do not stop the other distributions.
+
+        :returns: True if the distribution was synced, False otherwise
+        """
+        LOG.info("Syncing %s", distro.name)
+        with profiling.phase("sync", distro.name):
+            try:
+                distro.sync()
+            except exception.ImgSyncException as e:
+                LOG.error("Cannot sync %s: %s", distro.name, e)
+                return False
+        return True
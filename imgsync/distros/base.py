@@ -1,6 +1,8 @@
 """Base class for all distributions."""
 
 import abc
+from concurrent import futures
+import contextlib
 import hashlib
 import os
 import tempfile
@@ -9,28 +11,66 @@ from oslo_config import cfg
 from oslo_log import log
 import requests
 
+from imgsync import cache
+from imgsync import compression as compression_utils
+from imgsync import delta
 from imgsync import exception
 from imgsync import glance
+from imgsync import hashing
+from imgsync import lock
+from imgsync import mirror
+from imgsync import profiling
+from imgsync import staging
 
 CONF = cfg.CONF
 
 LOG = log.getLogger(__name__)
 
+# Conservative estimation of the ratio between the size of a decompressed
+# image and the size of its compressed artifact, used to reserve staging space
+# when only the size of the latter is known.
+COMPRESSION_RATIO = 8
+
 
 class BaseDistro(object, metaclass=abc.ABCMeta):
     """Base class for all distributions."""
 
     url = None
+    # Base URL of the upstream repository, whose layout is reproduced when
+    # exporting images into the mirror directory.
+    base_url = None
+    # Whether upstream checksum files mark the files as binary ("*name").
+    binary_checksums = False
+    # Compression of the upstream artifact (one of
+    # compression.SUPPORTED_COMPRESSIONS) and, for tarballs, the member
+    # containing the disk image.
+    compression = None
+    archive_member = None
+    # Whether upstream publishes zsync control files next to the images.
+    zsync = False
 
-    def __init__(self):
-        """Initialize the BaseDistro object."""
-        self.glance = glance.GLANCE
+    @property
+    def targets(self):
+        """Get the Glance targets where images are synced."""
+        return glance.get_targets()
 
     @abc.abstractproperty
     def what(self):
         """Get what to sync. This has to be implemented by the child class."""
         return None
 
+    @abc.abstractmethod
+    def _get_latest(self):
+        """Get the latest image available upstream.
+
+        :returns: dict with the image name, url, distro, checksum_type,
+                  checksum, architecture, file_format, last_modified (the
+                  Last-Modified header of the upstream checksum file, if any)
+                  and optionally alternate_urls (other upstream urls of the
+                  same image, e.g. in a dated build directory), or None if it
+                  cannot be obtained.
+        """
+
     def sync(self):
         """Sync the images, calling the method that is needed."""
         if self.what == "all":
@@ -40,6 +80,112 @@ class BaseDistro(object, metaclass=abc.ABCMeta):
         else:
             LOG.warn("Nothing to do")
 
+    def _sync_latest(self):
+        """Sync the latest image."""
+        with profiling.phase("manifest", self.name):
+            image = self._get_latest()
+        if image is None:
+            return
+
+        LOG.info("Syncing %s", image["url"])
+        with profiling.phase("check", self.name):
+            targets = self._needs_download(
+                image["name"], image["checksum_type"], image["checksum"]
+            )
+            export = self._needs_export(
+                [image["url"]] + image.get("alternate_urls", []),
+                image["distro"],
+                image["checksum_type"],
+                image["checksum"],
+            )
+        with contextlib.ExitStack() as locks:
+            targets = self._lock_targets(
+                locks,
+                targets,
+                image["name"],
+                image["checksum_type"],
+                image["checksum"],
+            )
+            if export:
+                export = self._lock_export(
+                    locks,
+                    [image["url"]] + image.get("alternate_urls", []),
+                    image["distro"],
+                    image["checksum_type"],
+                    image["checksum"],
+                )
+            if targets or export:
+                self._sync_with_glance(targets, export=export, **image)
+
+    def plan(self):
+        """Plan the sync of the latest image, without transferring it.
+
+        :returns: list of dicts with the action ("create", "update", "skip",
+                  "download" or "error") for each Glance target.
+        """
+        with profiling.phase("manifest", self.name):
+            try:
+                image = self._get_latest()
+            except Exception as e:
+                LOG.error("Cannot get the latest image of %s: %s", self.name, e)
+                image = None
+        if image is None:
+            return [
+                dict(
+                    distro=self.name,
+                    target=None,
+                    name=None,
+                    url=None,
+                    action="error",
+                    size=None,
+                )
+            ]
+
+        size = self._get_size(image["url"])
+        plan = []
+        for target in [None] if CONF.download_only else self.targets:
+            if target is None:
+                action = "download"
+                if CONF.mirror_dir and not self._needs_export(
+                    [image["url"]] + image.get("alternate_urls", []),
+                    image["distro"],
+                    image["checksum_type"],
+                    image["checksum"],
+                ):
+                    action = "skip"
+            else:
+                try:
+                    action = self._plan_target(
+                        target, image["name"], image["checksum_type"], image["checksum"]
+                    )
+                except Exception as e:
+                    LOG.error(
+                        "Cannot check %s in %s: %s", image["name"], target.name, e
+                    )
+                    action = "error"
+            plan.append(
+                dict(
+                    distro=self.name,
+                    target=getattr(target, "name", None),
+                    name=image["name"],
+                    url=image["url"],
+                    action=action,
+                    size=size,
+                )
+            )
+        return plan
+
+    def _plan_target(self, target, name, checksum_type, checksum):
+        """Get the action that a sync would do in a Glance target."""
+        image = target.get_image_by_name(name)
+        if image is None or image.get("imgsync.%s" % checksum_type) != checksum:
+            image = target.get_image_by_checksum(checksum_type, checksum)
+        if image is None:
+            return "create"
+        if target.get_metadata_changes(image, name):
+            return "update"
+        return "skip"
+
     def _get_file_checksum(self, path, block_size=2**20):
         """Get the checksum of a file.
 
@@ -57,59 +203,163 @@ class BaseDistro(object, metaclass=abc.ABCMeta):
                 buf = f.read(block_size)
         return sha512
 
-    def _download_one(self, url, checksum):
+    def _get_size(self, url):
+        """Get the size of a remote file, or None if it is unknown."""
+        try:
+            response = requests.head(url, allow_redirects=True, timeout=10)
+            return int(response.headers["Content-Length"])
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            LOG.debug("Cannot get size of %s: %s", url, e)
+            return None
+
+    def _open_stream(self, url):
+        """Open a streamed download of a url."""
+        try:
+            response = requests.get(url, stream=True, timeout=10)
+        except requests.exceptions.RequestException as e:
+            LOG.error(e)
+            raise exception.ImageDownloadFailed(code=type(e).__name__, reason=e)
+
+        if not response.ok:
+            LOG.error(
+                "Cannot download image: (%s) %s",
+                response.status_code,
+                response.reason,
+            )
+            raise exception.ImageDownloadFailed(
+                code=response.status_code, reason=response.reason
+            )
+        return response
+
+    def _copy_stream(self, response, fd, compression=None, member=None):
+        """Copy a download into a file object, decompressing it if needed.
+
+        The md5, sha256 and sha512 digests of the downloaded data (and of the
+        decompressed data, if it is compressed) are computed in the same pass.
+
+        :param response: streamed response to copy
+        :param fd: file-like object where the data is written
+        :param compression: compression of the file, if any
+        :param member: for compressed tarballs, the member to extract
+        :returns: tuple with the digests of the downloaded data and the digests
+                  of the data written into fd
+        """
+        block_size = compression_utils.BLOCK_SIZE
+        hasher = hashing.MultiHasher()
+        image_hasher = hashing.MultiHasher() if compression else hasher
+        reader = compression_utils.HashingReader(response.iter_content(2**16), hasher)
+        try:
+            if compression:
+                writer = hashing.HashingWriter(fd, image_hasher)
+                compression_utils.decompress(reader, writer, compression, member)
+            else:
+                block = reader.read(block_size)
+                while block:
+                    fd.write(block)
+                    block = reader.read(block_size)
+        finally:
+            # Time spent here is hashing that did not overlap with the I/O.
+            with profiling.phase("hash", self.name):
+                checksums = hasher.hexdigests()
+                image_checksums = image_hasher.hexdigests()
+        LOG.debug("Downloaded %s bytes from %s", reader.bytes_read, response.url)
+        return checksums, image_checksums
+
+    def _download_one(self, url, checksum, compression=None, member=None):
         """Download a file.
 
-        Download a file from a url and return a temporary file object.
+        Download a file from a url into the staging directory and return a
+        temporary file object. If the file is compressed it is decompressed on
+        the fly, verifying the checksum of the compressed data as listed in
+        the upstream manifest.
 
         :param url: the url to download
         :param checksum: tuple in the form (checksum_name, checksum_value)
-        :returns: temporary file object
+        :param compression: compression of the file, if any
+        :param member: for compressed tarballs, the member to extract
+        :returns: tuple with the temporary file object, the digests of the
+                  downloaded data and the digests of the staged data
         """
+        if not compression:
+            downloaded = self._download_delta(url, checksum)
+            if downloaded is not None:
+                return downloaded
+
         LOG.info("Downloading %s", url)
 
-        with tempfile.NamedTemporaryFile(suffix=".imgsync", delete=False) as location:
+        with tempfile.NamedTemporaryFile(
+            suffix=".imgsync", dir=staging.STAGING.directory, delete=False
+        ) as location:
             try:
-                response = requests.get(url, stream=True, timeout=10)
-            except Exception as e:
+                response = self._open_stream(url)
+                checksums, image_checksums = self._copy_stream(
+                    response, location, compression, member
+                )
+            except BaseException as e:
+                # Also remove the partial file on errors that are not ours,
+                # e.g. a full disk or a dropped connection.
                 os.remove(location.name)
+                if isinstance(e, (requests.exceptions.RequestException, OSError)):
+                    e = exception.ImageDownloadFailed(code=type(e).__name__, reason=e)
                 LOG.error(e)
-                raise exception.ImageDownloadFailed(code=e.errno, reason=e.message)
+                raise e
+
+        self._check_digest(location, checksum, checksums[checksum[0]], url)
+        return location, checksums, image_checksums
+
+    def _download_delta(self, url, checksum):
+        """Download a file reusing the previous revision in the cache.
+
+        :param url: the url to download
+        :param checksum: tuple in the form (checksum_name, checksum_value)
+        :returns: tuple with the temporary file object and its digests (twice,
+                  as in _download_one), or None if a delta download is not
+                  possible and the whole file has to be downloaded
+        """
+        if not (CONF.delta_sync and self.zsync):
+            return None
+        if not delta.MD4_AVAILABLE:
+            LOG.warning("MD4 is not available in hashlib, cannot do a delta sync")
+            return None
+
+        filename = os.path.basename(url)
+        cached = cache.get_path(self.name, filename)
+        if cached is None:
+            LOG.debug("No cached revision of %s, cannot do a delta sync", filename)
+            return None
 
-            if not response.ok:
+        LOG.info("Downloading %s (delta from cached revision)", url)
+        with tempfile.NamedTemporaryFile(
+            suffix=".imgsync", dir=staging.STAGING.directory, delete=False
+        ) as location:
+            try:
+                downloaded = delta.fetch(url, url + ".zsync", cached, location)
+            except exception.DeltaSyncFailed as e:
+                LOG.warning("Downloading the whole image: %s", e)
                 os.remove(location.name)
-                LOG.error(
-                    "Cannot download image: (%s) %s",
-                    response.status_code,
-                    response.reason,
-                )
-                raise exception.ImageDownloadFailed(
-                    code=response.status_code, reason=response.reason
-                )
+                return None
 
-            for block in response.iter_content(1024):
-                if block:
-                    location.write(block)
-                    location.flush()
+        checksums = hashing.file_digests(location.name)
+        try:
+            self._check_digest(location, checksum, checksums[checksum[0]], url)
+        except exception.ImageVerificationFailed:
+            LOG.warning("Delta sync of %s failed, downloading the whole image", url)
+            return None
 
-        self.verify_checksum(location, url, checksum, url)
-        return location
+        LOG.info("Downloaded %s bytes of %s", downloaded, url)
+        return location, checksums, checksums
 
     def verify_checksum(self, location, name, checksum, url):
         """Verify the image's checksum."""
-        checksum_map = {"sha512": hashlib.sha512, "sha256": hashlib.sha256}
-        sha = checksum_map.get(checksum[0])()
-        block_size = 2**20
-        with open(location.name, "rb") as f:
-            buf = f.read(block_size)
-            while len(buf) > 0:
-                sha.update(buf)
-                buf = f.read(block_size)
+        checksums = hashing.file_digests(location.name, (checksum[0],))
+        return self._check_digest(location, checksum, checksums[checksum[0]], url)
 
-        if sha.hexdigest() != checksum[1]:
+    def _check_digest(self, location, checksum, obtained, url):
+        """Check an obtained digest against the expected checksum."""
+        if obtained != checksum[1]:
             os.remove(location.name)
             e = exception.ImageVerificationFailed(
-                url=url, expected=checksum, obtained=sha.hexdigest()
+                url=url, expected=checksum, obtained=obtained
             )
             LOG.error(e)
             raise e
@@ -118,47 +368,416 @@ class BaseDistro(object, metaclass=abc.ABCMeta):
         return location
 
     def _needs_download(self, name, checksum_type, checksum):
-        """Check if the image needs to be downloaded."""
+        """Check if the image needs to be downloaded.
+
+        :returns: list of the Glance targets where the image has to be synced
+        """
         if CONF.download_only:
-            return True
+            # A site that only mirrors the images downloads them when they
+            # have to be exported, as checked by _needs_export.
+            if CONF.mirror_dir:
+                return []
+            return list(self.targets)
+
+        targets = []
+        for target in self.targets:
+            try:
+                if self._target_needs_sync(target, name, checksum_type, checksum):
+                    targets.append(target)
+            except Exception as e:
+                LOG.error("Cannot check image %s in %s: %s", name, target.name, e)
+        return targets
+
+    def _target_needs_sync(self, target, name, checksum_type, checksum):
+        """Check if the image needs to be synced into a Glance target."""
+        image = target.get_image_by_name(name)
+        if image and image.get("imgsync.%s" % checksum_type) == checksum:
+            LOG.info("Image already downloaded and synchroniced in %s", target.name)
+            self._reconcile(target, image, name)
+            return False
+
+        # The same bytes may already be in the catalog under another name
+        # (e.g. the prefix has changed), so only update its metadata.
+        other = target.get_image_by_checksum(checksum_type, checksum)
+        if other:
+            LOG.info(
+                "Image already synchronized in %s as '%s' (%s)",
+                target.name,
+                other.name,
+                other.id,
+            )
+            self._reconcile(target, other, name)
+            return False
 
-        image = self.glance.get_image_by_name(name)
         if image:
-            if image.get("imgsync.%s" % checksum_type) == checksum:
-                LOG.info("Image already downloaded and synchroniced")
-                return False
-            else:
-                LOG.error(
-                    "Glance image chechsum (%s, %s) and official "
-                    "checksum %s missmatch.",
-                    image.id,
-                    image.get("imgsync.%s" % checksum_type),
-                    checksum,
-                )
+            LOG.error(
+                "Glance image chechsum (%s, %s) and official " "checksum %s missmatch.",
+                image.id,
+                image.get("imgsync.%s" % checksum_type),
+                checksum,
+            )
         return True
 
+    def _lock_targets(self, locks, targets, name, checksum_type, checksum):
+        """Lock the image in the targets, so no other process syncs it.
+
+        Targets where the image is locked by another process are skipped.
+        Once the lock is taken the images of the target are listed again, as
+        the image may have been synced by another process in the meanwhile,
+        and the images left by runs killed while uploading it are removed.
+
+        :param locks: ExitStack where the acquired locks are released
+        :returns: list of the locked targets that still need the image
+        """
+        if CONF.dry_run:
+            return targets
+
+        locked = []
+        for target in targets:
+            image_lock = lock.Lock(target.name, checksum_type, checksum)
+            if not image_lock.acquire():
+                LOG.warning(
+                    "Image %s is being synced into %s by another process (%s), "
+                    "skipping it",
+                    name,
+                    target.name,
+                    image_lock.owner,
+                )
+                continue
+            locks.callback(image_lock.release)
+
+            if CONF.download_only:
+                locked.append(target)
+                continue
+            target.refresh()
+            try:
+                if self._target_needs_sync(target, name, checksum_type, checksum):
+                    self._remove_leftovers(target, checksum_type, checksum)
+                    locked.append(target)
+            except Exception as e:
+                LOG.error("Cannot check image %s in %s: %s", name, target.name, e)
+        return locked
+
+    def _remove_leftovers(self, target, checksum_type, checksum):
+        """Remove the images left behind by runs killed while uploading them.
+
+        This is only safe with the image locked, as otherwise the leftovers
+        could be uploads in progress of another process.
+        """
+        for image in target.get_leftovers(checksum_type, checksum):
+            LOG.warning(
+                "Removing image %s (%s) from %s, left %s by a previous run",
+                image.id,
+                image.name,
+                target.name,
+                image.get("status"),
+            )
+            target.delete_image(image)
+
+    def _lock_export(self, locks, urls, distro, checksum_type, checksum):
+        """Lock the export of the image, so no other process exports it.
+
+        The export is skipped if it is locked by another process. Once the
+        lock is taken the mirror is checked again, as the image may have been
+        exported by another process in the meanwhile.
+
+        :param locks: ExitStack where the acquired lock is released
+        :param urls: upstream urls of the image, reproduced in the mirror
+        :returns: True if the image still has to be exported
+        """
+        export_lock = lock.Lock("mirror", checksum_type, checksum)
+        if not export_lock.acquire():
+            LOG.warning(
+                "Image %s is being exported into the mirror by another process "
+                "(%s), skipping it",
+                urls[0],
+                export_lock.owner,
+            )
+            return False
+        locks.callback(export_lock.release)
+        return self._needs_export(urls, distro, checksum_type, checksum)
+
+    def _mirror_path(self, url):
+        """Get the path of an image url relative to the upstream base url."""
+        if not self.base_url or not url.startswith(self.base_url):
+            return None
+        start = len(self.base_url)
+        return url[start:]
+
+    def _needs_export(self, urls, distro, checksum_type, checksum):
+        """Check if the image has to be exported into the mirror directory.
+
+        :param urls: upstream urls of the image, reproduced in the mirror
+        """
+        if not CONF.mirror_dir or CONF.dry_run:
+            return False
+        if self.compression:
+            LOG.warning(
+                "Not exporting %s into the mirror, compressed artifacts are "
+                "not supported",
+                urls[0],
+            )
+            return False
+        return any(
+            mirror.needs_export(distro, self._mirror_path(url), checksum_type, checksum)
+            for url in urls
+        )
+
+    def _export(self, path, urls, distro, checksums, last_modified):
+        """Export a verified image into the mirror directory.
+
+        :param urls: upstream urls of the image, reproduced in the mirror
+        """
+        for url in urls:
+            mirror.export(
+                path,
+                distro,
+                self._mirror_path(url),
+                checksums,
+                binary=self.binary_checksums,
+                last_modified=last_modified,
+            )
+
+    def _reconcile(self, target, image, name):
+        """Update the metadata of an already synced image, if needed."""
+        if CONF.dry_run:
+            LOG.info("Not reconciling metadata of image %s (dry run)", image.id)
+            return
+        target.update_metadata(image, name)
+
     def _sync_with_glance(
-        self, name, url, distro, checksum_type, checksum, architecture, file_format
+        self,
+        targets,
+        name,
+        url,
+        distro,
+        checksum_type,
+        checksum,
+        architecture,
+        file_format,
+        last_modified=None,
+        alternate_urls=None,
+        export=False,
+    ):
+        """Download the image once and upload it to the given Glance targets.
+
+        The image is staged on disk if there is enough space for it, otherwise
+        it is streamed to the targets as it is being downloaded. Staged images
+        are also exported into the mirror directory, if export is True.
+        """
+        kwargs = dict(
+            architecture=architecture,
+            file_format=file_format,
+            container_format="bare",
+            checksum={checksum_type: checksum},
+            os_distro=distro,
+            os_version=self.version,
+        )
+
+        size = self._get_size(url)
+        if size and self.compression:
+            size *= COMPRESSION_RATIO
+
+        with staging.STAGING.reserve(size, name) as admitted:
+            if admitted:
+                images = self._sync_staged(
+                    targets,
+                    name,
+                    url,
+                    checksum_type,
+                    checksum,
+                    kwargs,
+                    mirror_urls=[url] + (alternate_urls or []) if export else None,
+                    last_modified=last_modified,
+                )
+            else:
+                if export:
+                    LOG.warning("Not exporting %s into the mirror, not staged", name)
+                images = self._sync_streamed(
+                    targets, name, url, checksum_type, checksum, kwargs
+                )
+
+        # Waiting for Glance to copy the images can take long, so it is done
+        # once the staged image has been removed and its space released.
+        self._copy_to_stores(images)
+
+    def _copy_to_stores(self, images):
+        """Copy the uploaded images into the rest of the stores of each target.
+
+        :param images: dict with the uploaded image for each target
+        """
+
+        def copy(target):
+            with profiling.phase("copy", self.name):
+                target.copy_to_stores(images[target])
+
+        if images:
+            with futures.ThreadPoolExecutor(max_workers=len(images)) as executor:
+                list(executor.map(copy, images))
+
+    def _sync_staged(
+        self,
+        targets,
+        name,
+        url,
+        checksum_type,
+        checksum,
+        kwargs,
+        mirror_urls=None,
+        last_modified=None,
     ):
-        """Upload the image to glance."""
+        """Download the image into the staging area and upload it.
+
+        :param mirror_urls: upstream urls of the image, reproduced in the
+                            mirror directory, or None to not export it
+        :returns: dict with the uploaded image for each target
+        """
+        images = {}
         location = None
         try:
-            location = self._download_one(url, (checksum_type, checksum))
-            if not (CONF.download_only or CONF.dry_run):
-                self.glance.upload(
-                    location,
+            with profiling.phase("download", self.name):
+                location, checksums, image_checksums = self._download_one(
+                    url,
+                    (checksum_type, checksum),
+                    compression=self.compression,
+                    member=self.archive_member,
+                )
+            # Only images that can be delta synced are worth keeping
+            if self.zsync and not self.compression:
+                cache.store(location.name, self.name, os.path.basename(url))
+            if mirror_urls:
+                self._export(
+                    location.name,
+                    mirror_urls,
+                    kwargs["os_distro"],
+                    checksums,
+                    last_modified,
+                )
+            if targets and not (CONF.download_only or CONF.dry_run):
+                kwargs = dict(
+                    kwargs, checksum=checksums, image_checksums=image_checksums
+                )
+                images = self._upload_to_targets(
+                    targets,
                     name,
-                    architecture=architecture,
-                    file_format=file_format,
-                    container_format="bare",
-                    checksum={checksum_type: checksum},
-                    os_distro=distro,
-                    os_version=self.version,
+                    lambda target: target.upload(location, name, **kwargs),
                 )
-                LOG.info("Synchronized %s", name)
             else:
                 LOG.info("Downloaded %s", name)
         finally:
             if location is not None:
                 LOG.debug("Removing %s", location.name)
                 os.remove(location.name)
+        return images
+
+    def _sync_streamed(self, targets, name, url, checksum_type, checksum, kwargs):
+        """Stream the image to the Glance targets while it is downloaded.
+
+        The data is downloaded only once and copied to all the targets. As the
+        checksum can only be verified once all the data has been uploaded, the
+        uploaded images are removed if the verification fails.
+
+        :returns: dict with the uploaded and verified image for each target
+        """
+        if not targets:
+            return {}
+        if CONF.download_only or CONF.dry_run:
+            LOG.error("Not enough staging space to download %s, skipping", name)
+            return {}
+
+        LOG.info("Streaming %s to Glance without staging it", url)
+        response = self._open_stream(url)
+        readers = {target.name: staging.QueueReader() for target in targets}
+        fanout = staging.Fanout(readers.values())
+
+        def produce():
+            try:
+                with profiling.phase("download", self.name):
+                    digests = self._copy_stream(
+                        response, fanout, self.compression, self.archive_member
+                    )
+            except Exception as e:
+                # As in _download_one, a dropped connection only fails this
+                # image and not the whole run.
+                if isinstance(e, (requests.exceptions.RequestException, OSError)):
+                    e = exception.ImageDownloadFailed(code=type(e).__name__, reason=e)
+                LOG.error(e)
+                fanout.close(e)
+                raise e
+            fanout.close()
+            return digests
+
+        def upload(target):
+            reader = readers[target.name]
+            try:
+                return target.upload_stream(reader, name, **kwargs)
+            finally:
+                reader.close()
+
+        with futures.ThreadPoolExecutor(max_workers=1) as executor:
+            producer = executor.submit(produce)
+            images = self._upload_to_targets(targets, name, upload)
+            checksums, image_checksums = producer.result()
+
+        obtained = checksums[checksum_type]
+        if obtained != checksum:
+            e = exception.ImageVerificationFailed(
+                url=url, expected=(checksum_type, checksum), obtained=obtained
+            )
+            LOG.error(e)
+            for target, image in images.items():
+                LOG.error("Removing image %s from %s", image.id, target.name)
+                target.delete_image(image)
+            raise e
+
+        # The digests are only known once all the data has been uploaded, so
+        # the uploads are verified and the properties set afterwards.
+        def finish(target):
+            image = images[target]
+            try:
+                with profiling.phase("verify", self.name):
+                    target.verify_upload(image, image_checksums)
+                    target.set_checksums(image, checksums)
+            except Exception as e:
+                LOG.error(e)
+                LOG.error("Removing image %s from %s", image.id, target.name)
+                target.delete_image(image)
+                return False
+            return True
+
+        if images:
+            with futures.ThreadPoolExecutor(max_workers=len(images)) as executor:
+                verified = list(executor.map(finish, images))
+            images = {t: i for (t, i), ok in zip(images.items(), verified) if ok}
+        return images
+
+    def _upload_to_targets(self, targets, name, upload):
+        """Upload an image to several Glance targets in parallel.
+
+        A failure in one of the targets does not affect the others.
+
+        :param targets: Glance targets where the image is uploaded
+        :param name: name of the image
+        :param upload: callable that uploads the image to the target passed as
+                       argument, returning the created image
+        :returns: dict with the created image for each successful target
+        """
+
+        def profiled_upload(target):
+            with profiling.phase("upload", self.name):
+                return upload(target)
+
+        images = {}
+        with futures.ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            jobs = {
+                executor.submit(profiled_upload, target): target for target in targets
+            }
+            for job in futures.as_completed(jobs):
+                target = jobs[job]
+                try:
+                    images[target] = job.result()
+                except Exception as e:
+                    LOG.error("Cannot sync %s to %s: %s", name, target.name, e)
+                else:
+                    LOG.info("Synchronized %s in %s", name, target.name)
+        return images
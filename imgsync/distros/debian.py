@@ -15,17 +15,36 @@
 # under the License.
 
 import abc
-import datetime
+import re
 
+import dateutil.parser
 from oslo_config import cfg
 from oslo_log import log
 import requests
 
 from imgsync.distros import base
 
+opts = [
+    cfg.StrOpt(
+        "debian_url",
+        default="https://cloud.debian.org/images/cloud/",
+        help="Base URL of the Debian cloud images repository. It can point to "
+        "the debian/ directory of the mirror_dir of another imgsync instance.",
+    ),
+]
+
 CONF = cfg.CONF
+CONF.register_opts(opts)
+
 LOG = log.getLogger(__name__)
 
+# Dated build directories, e.g. "20240507-1740/", as listed in the index
+BUILD_RE = re.compile(r'href="(\d{8}-\d{4})/"')
+
+# Number of build directories, newest first, where the build that latest/
+# points to is searched for.
+MAX_BUILDS = 5
+
 
 class Debian(base.BaseDistro, metaclass=abc.ABCMeta):
     """Base class for all Debian distributions."""
@@ -43,56 +62,167 @@ class Debian(base.BaseDistro, metaclass=abc.ABCMeta):
         """Get what to sync. In debian we can only sync latest."""
         return "latest"
 
+    @property
+    def base_url(self):
+        """Get the base URL of the Debian cloud images repository."""
+        return CONF.debian_url.rstrip("/") + "/"
+
+    @property
+    def releases_url(self):
+        """Get the URL containing the dated builds of the Debian release."""
+        return self.base_url + "%s/" % self.debian_release
+
     @property
     def url(self):
         """Get the URL of the Debian cloud images."""
-        return "https://cloud.debian.org/images/cloud/%s/latest/" % self.debian_release
+        return self.releases_url + "latest/"
+
+    def _get_builds(self):
+        """Get the dated build directories of the release, newest first.
+
+        :returns: list of build names (e.g. "20240507-1740"), empty if the
+                  index cannot be fetched or parsed.
+        """
+        try:
+            response = requests.get(self.releases_url, timeout=10)
+        except requests.exceptions.RequestException as e:
+            LOG.warning("Could not get builds index %s: %s", self.releases_url, e)
+            return []
+
+        if response.status_code != 200:
+            LOG.warning("Could not get builds index %s", self.releases_url)
+            return []
+
+        return sorted(set(BUILD_RE.findall(response.text)), reverse=True)
+
+    def _get_checksums(self, url):
+        """Get the SHA512SUMS file in a directory.
+
+        :returns: tuple with a dict mapping file names to checksums and the
+                  response, or None if it cannot be fetched
+        """
+        try:
+            response = requests.get(url + "SHA512SUMS", timeout=10)
+        except requests.exceptions.RequestException as e:
+            LOG.warning("Could not get checksums file %sSHA512SUMS: %s", url, e)
+            return None
+        if response.status_code != 200:
+            return None
+
+        checksums = {}
+        for line in response.text.splitlines():
+            fields = line.split()
+            if len(fields) == 2:
+                checksums[fields[1].lstrip("*")] = fields[0]
+        return checksums, response
+
+    def _get_build_filename(self, build):
+        """Get the file name of the image inside a dated build directory."""
+        start = len(self.basename)
+        return "%s-%s%s" % (self.basename, build, self.filename[start:])
+
+    def _find_build(self, checksum):
+        """Find the dated build directory that ``latest/`` points to.
+
+        Builds are published as dated directories, with versioned file names,
+        and the newest one may not be complete yet, so the build is the one
+        whose image has the same checksum as the image in ``latest/``.
+
+        :param checksum: checksum of the image in ``latest/``
+        :returns: the build name (e.g. "20240507-1740") or None if not found
+        """
+        for build in self._get_builds()[:MAX_BUILDS]:
+            checksums = self._get_checksums(self.releases_url + build + "/")
+            if checksums is None:
+                LOG.debug("Build %s has no checksums file, skipping it", build)
+                continue
+            if checksums[0].get(self._get_build_filename(build)) == checksum:
+                return build
+        return None
+
+    @property
+    def basename(self):
+        """Get the base name of the image files, based on the Debian release."""
+        return "debian-%s-genericcloud-amd64" % self.version
 
     @property
     def filename(self):
         """Get the filename of the image, based on the Debian release."""
-        return "debian-%s-genericcloud-amd64.qcow2" % self.version
+        if CONF.fetch_compressed:
+            return self.basename + ".tar.xz"
+        return self.basename + ".qcow2"
 
-    def _sync_latest(self):
-        """Sync the latest image."""
-        base_url = self.url
+    @property
+    def file_format(self):
+        """Get the disk format of the image that is synced."""
+        if CONF.fetch_compressed:
+            return "raw"
+        return "qcow2"
 
-        checksum_file = base_url + "SHA512SUMS"
-        checksum_file = requests.get(checksum_file, timeout=10)
-        if checksum_file.status_code != 200:
-            LOG.error("Could not get checksums file %s" % checksum_file.url)
-            return
+    @property
+    def compression(self):
+        """Get the compression of the artifact that is downloaded."""
+        if CONF.fetch_compressed:
+            return "xz"
+        return None
 
-        aux = dict(
-            [list(reversed(line.split())) for line in checksum_file.text.splitlines()]
-        )
+    @property
+    def archive_member(self):
+        """Get the archive member containing the disk image."""
+        if CONF.fetch_compressed:
+            return "disk.raw"
+        return None
+
+    def _get_latest(self):
+        """Get the latest image."""
+        base_url = self.url
+        checksums = self._get_checksums(base_url)
+        if checksums is None:
+            LOG.error("Could not get checksums file %sSHA512SUMS" % base_url)
+            return
+        checksums, checksum_file = checksums
 
         filename = self.filename
-
-        checksum = None
-        for k, v in aux.items():
-            if k == filename:
-                checksum = v
-                break
+        checksum = checksums.get(filename)
         if not checksum:
             LOG.error("Could not find checksum for %s" % filename)
             return
 
-        LOG.info("Syncing %s", filename)
+        # Use the upstream build as revision, so that the image name only
+        # changes when there is a new build and not every day.
+        last_modified = checksum_file.headers.get("Last-Modified")
+        alternate_urls = []
+        revision = self._find_build(checksum)
+        if revision:
+            alternate_urls.append(
+                "%s%s/%s"
+                % (self.releases_url, revision, self._get_build_filename(revision))
+            )
+        else:
+            if not last_modified:
+                LOG.error("Could not get revision for %s" % base_url)
+                return
+            revision = dateutil.parser.parse(last_modified).strftime("%Y%m%d")
 
         url = base_url + filename
         architecture = "x86_64"
-        file_format = "qcow2"
+        file_format = self.file_format
 
-        revision = datetime.datetime.now().strftime("%Y%m%d")
         prefix = CONF.prefix
         name = "%sDebian %s [%s]" % (prefix, self.version, revision)
         sha = "sha512"
 
-        if self._needs_download(name, sha, checksum):
-            self._sync_with_glance(
-                name, url, "debian", sha, checksum, architecture, file_format
-            )
+        return dict(
+            name=name,
+            url=url,
+            distro="debian",
+            checksum_type=sha,
+            checksum=checksum,
+            architecture=architecture,
+            file_format=file_format,
+            last_modified=last_modified,
+            alternate_urls=alternate_urls,
+        )
 
     def _sync_all(self):
         """Sync all images."""
@@ -124,14 +254,11 @@ class DebianTesting(Debian):
     name = "debian-testing"
 
     @property
-    def url(self):
-        """Get the URL of the Debian cloud images."""
-        return (
-            "https://cloud.debian.org/images/cloud/%s/daily/latest/"
-            % self.debian_release
-        )
+    def releases_url(self):
+        """Get the URL containing the daily builds of Debian testing."""
+        return self.base_url + "%s/daily/" % self.debian_release
 
     @property
-    def filename(self):
-        """Get the filename of the image, based on the Debian release."""
-        return "debian-%s-genericcloud-amd64-daily.qcow2" % self.debian_release
+    def basename(self):
+        """Get the base name of the image files, based on the Debian release."""
+        return "debian-%s-genericcloud-amd64-daily" % self.debian_release
@@ -23,7 +23,18 @@ import requests
 
 from imgsync.distros import base
 
+opts = [
+    cfg.StrOpt(
+        "ubuntu_url",
+        default="https://repo.ifca.es/ubuntu-cloud-images/",
+        help="Base URL of the Ubuntu cloud images repository. It can point to "
+        "the ubuntu/ directory of the mirror_dir of another imgsync instance.",
+    ),
+]
+
 CONF = cfg.CONF
+CONF.register_opts(opts)
+
 LOG = log.getLogger(__name__)
 
 
@@ -33,6 +44,8 @@ class Ubuntu(base.BaseDistro, metaclass=abc.ABCMeta):
     ubuntu_release = None
     version = None
     name = "ubuntu"
+    zsync = True
+    binary_checksums = True
 
     def __init__(self):
         """Initialize the Ubuntu object."""
@@ -48,20 +61,27 @@ class Ubuntu(base.BaseDistro, metaclass=abc.ABCMeta):
         """Get the filename of the image, based on the Ubuntu release."""
         return "%s-server-cloudimg-amd64.img" % self.ubuntu_release
 
+    @property
+    def base_url(self):
+        """Get the base URL of the Ubuntu cloud images repository."""
+        return CONF.ubuntu_url.rstrip("/") + "/"
+
     @property
     def url(self):
         """Get the URL of the Ubuntu cloud images."""
-        return "https://repo.ifca.es/ubuntu-cloud-images/%s/" % self.ubuntu_release
+        return self.base_url + "%s/" % self.ubuntu_release
 
-    def _sync_latest(self):
-        """Sync the latest image."""
+    def _get_latest(self):
+        """Get the latest image."""
         filename = self.filename
 
-        LOG.info("Syncing %s", filename)
-
         base_url = self.url + "current/"
         checksum_file = base_url + "SHA256SUMS"
-        checksum_file = requests.get(checksum_file, timeout=10)
+        try:
+            checksum_file = requests.get(checksum_file, timeout=10)
+        except requests.exceptions.RequestException as e:
+            LOG.error("Could not get checksums file %s: %s", checksum_file, e)
+            return
         if checksum_file.status_code != 200:
             LOG.error("Could not get checksums file %s" % checksum_file.url)
             return
@@ -70,22 +90,34 @@ class Ubuntu(base.BaseDistro, metaclass=abc.ABCMeta):
             [list(reversed(line.split())) for line in checksum_file.text.splitlines()]
         )
 
-        checksum = aux["*%s" % filename]
+        checksum = aux.get("*%s" % filename)
+        if not checksum:
+            LOG.error("Could not find checksum for %s" % filename)
+            return
         url = base_url + filename
         architecture = "x86_64"
         file_format = "qcow2"
 
-        revision = checksum_file.headers.get("Last-Modified")
-        revision = dateutil.parser.parse(revision).strftime("%Y-%m-%d")
+        last_modified = checksum_file.headers.get("Last-Modified")
+        if not last_modified:
+            LOG.error("Could not get revision for %s" % base_url)
+            return
+        revision = dateutil.parser.parse(last_modified).strftime("%Y-%m-%d")
 
         prefix = CONF.prefix
         name = "%sUbuntu %s [%s]" % (prefix, self.version, revision)
         sha = "sha256"
 
-        if self._needs_download(name, sha, checksum):
-            self._sync_with_glance(
-                name, url, "ubuntu", sha, checksum, architecture, file_format
-            )
+        return dict(
+            name=name,
+            url=url,
+            distro="ubuntu",
+            checksum_type=sha,
+            checksum=checksum,
+            architecture=architecture,
+            file_format=file_format,
+            last_modified=last_modified,
+        )
 
     def _sync_all(self):
         """Sync all images."""
@@ -52,3 +52,30 @@ class ImageVerificationFailed(ImgSyncException):
     """Image verification failed."""
 
     msg_fmt = "Image %(url)s verification failed %(expected)s != %(obtained)s"
+
+
+class ImageDecompressionFailed(ImgSyncException):
+    """Image decompression failed."""
+
+    msg_fmt = "Cannot decompress image, reason: %(reason)s"
+
+
+class DeltaSyncFailed(ImgSyncException):
+    """Delta sync of an image failed."""
+
+    msg_fmt = "Cannot do a delta sync, reason: %(reason)s"
+
+
+class ImageUploadVerificationFailed(ImgSyncException):
+    """Verification of an uploaded image failed."""
+
+    msg_fmt = (
+        "Image %(image)s uploaded to %(target)s is corrupted, %(algorithm)s "
+        "%(expected)s != %(obtained)s"
+    )
+
+
+class DistroSyncFailed(ImgSyncException):
+    """Some distributions could not be synced."""
+
+    msg_fmt = "Cannot sync %(distros)s"
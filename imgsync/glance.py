@@ -14,11 +14,17 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import threading
+import time
+
 import glanceclient
 from keystoneauth1 import loading
 from oslo_config import cfg
 from oslo_log import log
 
+from imgsync import exception
+from imgsync import profiling
+
 CONF = cfg.CONF
 
 cfg_group = "keystone_auth"
@@ -32,45 +38,207 @@ opts = (
     + loading.get_auth_plugin_conf_options("password")
 )
 
+target_opts = [
+    cfg.ListOpt(
+        "glance_targets",
+        default=[],
+        help="List of named Glance targets where the images will be uploaded. "
+        "Each target NAME reads its Keystone authentication and session options "
+        "from a [glance:NAME] section. Images are downloaded only once and then "
+        "uploaded to all the targets in parallel. If empty, only the Glance "
+        "configured in the [keystone_auth] section is used.",
+    ),
+]
+
+store_opts = [
+    cfg.ListOpt(
+        "stores",
+        default=[],
+        help="Glance stores (with multiple stores enabled in Glance) where the "
+        "images are placed. Images are uploaded into the first store and then "
+        "Glance copies them into the rest with the copy-image import method, "
+        "so the data is only transferred once from this host. If empty, images "
+        "are uploaded into the default store.",
+    ),
+    cfg.IntOpt(
+        "copy_timeout",
+        default=3600,
+        min=0,
+        help="Seconds to wait for Glance to copy an image into the rest of the "
+        "stores. Copies still running after this time are not waited for.",
+    ),
+]
+
+CONF.register_opts(target_opts)
+CONF.register_opts(store_opts, cfg_group)
+
 LOG = log.getLogger(__name__)
 
+# Seconds between checks of the progress of the copies into other stores.
+COPY_POLL_INTERVAL = 10
+
+
+def _split_stores(value):
+    """Split a comma separated list of stores, as returned by Glance."""
+    return [i.strip() for i in (value or "").split(",") if i.strip()]
+
 
 class GlanceClient(object):
     """Glance client."""
 
-    def __init__(self):
-        """Initialize the Glance client."""
+    def __init__(self, name="default", group=cfg_group):
+        """Initialize the Glance client.
+
+        :param name: name of the target, used for logging
+        :param group: configuration group holding the auth and session options
+        """
+        self.name = name
+        self.group = group
         self._images = None
+        self._leftovers = None
         self._client = None
+        self._lock = threading.Lock()
+
+        if group != cfg_group:
+            loading.register_auth_conf_options(CONF, group)
+            loading.register_session_conf_options(CONF, group)
+            CONF.register_opts(store_opts, group)
+
+    @property
+    def stores(self):
+        """Get the Glance stores where images are placed."""
+        return CONF[self.group].stores
 
     @property
     def client(self):
         """Get the glance client."""
         # Defer the client creation to when it is needed.
-        if self._client is None:
-            self._client = self._get_session()
+        with self._lock:
+            if self._client is None:
+                with profiling.phase("keystone"):
+                    self._client = self._get_session()
         return self._client
 
     def _get_session(self):
         """Get an auth session."""
-        auth_plugin = loading.load_auth_from_conf_options(CONF, cfg_group)
-        sess = loading.load_session_from_conf_options(CONF, cfg_group, auth=auth_plugin)
+        auth_plugin = loading.load_auth_from_conf_options(CONF, self.group)
+        sess = loading.load_session_from_conf_options(
+            CONF, self.group, auth=auth_plugin
+        )
 
         return glanceclient.Client("2", session=sess)
 
+    def _list_images(self):
+        """List the images stored in glance by imgsync, if not listed yet.
+
+        Images that are not active (e.g. left "queued" or "saving" by a run
+        that was killed while uploading them) are kept apart as leftovers, as
+        their data is missing or incomplete.
+
+        :returns: tuple with the dict of active images by name and the list of
+                  leftovers
+        """
+        client = self.client
+        with self._lock:
+            if self._images is None:
+                with profiling.phase("catalog"):
+                    images = list(client.images.list(filters={"source": "imgsync"}))
+                self._images = {
+                    image.name: image
+                    for image in images
+                    if image.get("status") == "active"
+                }
+                self._leftovers = [
+                    image for image in images if image.get("status") != "active"
+                ]
+            return self._images, self._leftovers
+
     @property
     def images(self):
-        """Get the images that are stored in glance, filtering by source."""
-        if self._images is None:
-            images = self.client.images.list(filters={"source": "imgsync"})
-            images = {image.name: image for image in images}
-            self._images = images
-        return self._images
+        """Get the active images that are stored in glance, by source."""
+        return self._list_images()[0]
+
+    def refresh(self):
+        """Forget the cached images, so that they are listed again."""
+        with self._lock:
+            self._images = None
+            self._leftovers = None
+
+    def get_leftovers(self, checksum_type, checksum):
+        """Get the images with a checksum that were not fully uploaded."""
+        leftovers = self._list_images()[1]
+        key = "imgsync.%s" % checksum_type
+        return [image for image in leftovers if image.get(key) == checksum]
+
+    def _get_properties(self):
+        """Get the configured properties to set in all images."""
+        try:
+            return dict([i.split("=", 1) for i in CONF.properties or []])
+        except ValueError:
+            LOG.error("Wrong 'properties' option defined in config file")
+            raise
 
     def get_image_by_name(self, name):
         """Get an image by name."""
         return self.images.get(name)
 
+    def get_image_by_checksum(self, checksum_type, checksum):
+        """Get an image by its imgsync checksum property."""
+        key = "imgsync.%s" % checksum_type
+        images = self.images
+        # The cache may be updated by other threads while it is iterated.
+        with self._lock:
+            images = list(images.values())
+        for image in images:
+            if image.get(key) == checksum:
+                return image
+        return None
+
+    def get_metadata_changes(self, image, name):
+        """Get the metadata of an image that differs from the expected one.
+
+        :param image: the glance image to check
+        :param name: the name that the image should have
+        :returns: dict with the attributes to update
+        """
+        metadata = self._get_properties()
+        metadata["name"] = name
+        metadata["visibility"] = "public"
+        return {k: v for k, v in metadata.items() if image.get(k) != v}
+
+    def update_metadata(self, image, name):
+        """Update the metadata of an image without transferring its data.
+
+        Set the name, visibility and configured properties of an image that
+        is already stored in glance, only sending the attributes that differ.
+
+        :param image: the glance image to update
+        :param name: the name that the image should have
+        :returns: the updated image
+        """
+        changes = self.get_metadata_changes(image, name)
+        if not changes:
+            return image
+
+        LOG.info(
+            "Updating metadata of image %s (%s): %s",
+            image.id,
+            image.name,
+            ", ".join(sorted(changes)),
+        )
+        old_name = image.name
+        image = self.client.images.update(image.id, **changes)
+
+        # Other threads may be reading the cache, or refreshing it (then the
+        # updated image is listed again).
+        with self._lock:
+            if self._images is not None:
+                cached = self._images.get(old_name)
+                if cached is not None and cached.id == image.id:
+                    del self._images[old_name]
+                self._images[image.name] = image
+        return image
+
     def upload(
         self,
         location,
@@ -82,19 +250,136 @@ class GlanceClient(object):
         os_distro,
         os_version,
         os_type="Linux",
+        image_checksums=None,
     ):
         """Upload an image to glance."""
-        self._upload_with_fd(
-            open(location.name, "rb"),
-            name,
-            architecture,
-            file_format,
-            container_format,
-            checksum,
-            os_distro,
-            os_version,
-            os_type=os_type,
+        with open(location.name, "rb") as fd:
+            return self._upload_with_fd(
+                fd,
+                name,
+                architecture,
+                file_format,
+                container_format,
+                checksum,
+                os_distro,
+                os_version,
+                os_type=os_type,
+                image_checksums=image_checksums,
+            )
+
+    def upload_stream(self, fd, name, **kwargs):
+        """Upload an image to glance, reading its data from a file object."""
+        return self._upload_with_fd(fd, name, **kwargs)
+
+    def delete_image(self, image):
+        """Delete an image from glance."""
+        self.client.images.delete(image.id)
+
+    def set_checksums(self, image, checksum):
+        """Set the imgsync checksum properties of an image."""
+        checksum = {"imgsync.%s" % k: v for k, v in checksum.items()}
+        return self.client.images.update(image.id, **checksum)
+
+    def verify_upload(self, image, image_checksums):
+        """Verify the data stored by glance without downloading it back.
+
+        Compare the checksums computed by glance for the stored data
+        (``os_hash_value`` and ``checksum``) with the ones computed locally for
+        the uploaded data.
+
+        :param image: the glance image to verify
+        :param image_checksums: dict with the digests of the uploaded data
+        :raises ImageUploadVerificationFailed: if the checksums do not match
+        """
+        image = self.client.images.get(image.id)
+        stored = {"md5": image.get("checksum")}
+        if image.get("os_hash_algo"):
+            stored[image.get("os_hash_algo")] = image.get("os_hash_value")
+
+        verified = False
+        for algorithm, value in stored.items():
+            if not value or algorithm not in image_checksums:
+                continue
+            if value != image_checksums[algorithm]:
+                raise exception.ImageUploadVerificationFailed(
+                    image=image.id,
+                    target=self.name,
+                    algorithm=algorithm,
+                    expected=image_checksums[algorithm],
+                    obtained=value,
+                )
+            verified = True
+
+        if verified:
+            LOG.debug("Verified upload of image %s in %s", image.id, self.name)
+        else:
+            LOG.warning("Cannot verify upload of image %s in %s", image.id, self.name)
+
+    def copy_to_stores(self, image):
+        """Copy an image from the store it was uploaded to into the rest.
+
+        Glance only runs one import task at a time for an image, so all the
+        stores are requested at once and Glance copies the data between its
+        backends. Failures are logged, as the image is usable anyway.
+
+        :param image: the glance image to copy
+        """
+        stores = self.stores[1:]
+        if not stores:
+            return
+
+        LOG.info(
+            "Copying image %s in %s into stores %s",
+            image.id,
+            self.name,
+            ", ".join(stores),
         )
+        try:
+            self.client.images.image_import(
+                image.id, method="copy-image", stores=stores, allow_failure=True
+            )
+        except Exception as e:
+            LOG.error(
+                "Cannot copy image %s in %s into stores %s: %s",
+                image.id,
+                self.name,
+                ", ".join(stores),
+                e,
+            )
+            return
+        self._wait_for_copy(image, stores)
+
+    def _wait_for_copy(self, image, stores):
+        """Wait until glance has copied an image into the given stores."""
+        deadline = time.monotonic() + CONF[self.group].copy_timeout
+        while True:
+            image = self.client.images.get(image.id)
+            present = _split_stores(image.get("stores"))
+            failed = _split_stores(image.get("os_glance_failed_import"))
+            failed = [i for i in stores if i in failed]
+            pending = [i for i in stores if i not in present and i not in failed]
+            if not pending:
+                break
+            if time.monotonic() >= deadline:
+                LOG.warning(
+                    "Image %s in %s is still being copied into stores %s, not "
+                    "waiting for it",
+                    image.id,
+                    self.name,
+                    ", ".join(pending),
+                )
+                break
+            time.sleep(COPY_POLL_INTERVAL)
+
+        if failed:
+            LOG.error(
+                "Cannot copy image %s in %s into stores %s",
+                image.id,
+                self.name,
+                ", ".join(failed),
+            )
+        elif not pending:
+            LOG.info("Image %s in %s copied into all the stores", image.id, self.name)
 
     def _upload_with_fd(
         self,
@@ -107,16 +392,18 @@ class GlanceClient(object):
         os_distro,
         os_version,
         os_type="Linux",
+        image_checksums=None,
     ):
-        """Inner function to upload an image to glance."""
-        os_version = str(os_version)
+        """Inner function to upload an image to glance.
 
-        try:
-            properties = dict([i.split("=") for i in CONF.properties])
-        except ValueError:
-            raise
-            LOG.error("Wrong 'properties' option defined in config file")
+        If image_checksums (the digests of the data read from fd) are given,
+        the checksums computed by glance are verified after the upload.
+        Otherwise the caller has to do it, once the data has been verified. In
+        any case the caller copies the image into the rest of the stores.
+        """
+        os_version = str(os_version)
 
+        properties = self._get_properties()
         checksum = {"imgsync.%s" % k: v for k, v in checksum.items()}
         properties.update(checksum)
         properties["source"] = "imgsync"
@@ -136,12 +423,38 @@ class GlanceClient(object):
             **properties
         )
 
+        stores = self.stores
         try:
-            self.client.images.upload(image.id, fd)
+            self.client.images.upload(
+                image.id, fd, backend=stores[0] if stores else None
+            )
+            if image_checksums:
+                self.verify_upload(image, image_checksums)
         except Exception as e:
-            LOG.error("Cannot upload image, an error has happened")
+            LOG.error("Cannot upload image to %s, an error has happened", self.name)
             LOG.exception(e)
             self.client.images.delete(image.id)
+            raise
+
+        return image
 
 
 GLANCE = GlanceClient()
+
+_TARGETS = None
+
+
+def get_targets():
+    """Get the configured Glance targets.
+
+    :returns: list of GlanceClient objects, one per configured target
+    """
+    global _TARGETS
+    if _TARGETS is None:
+        if CONF.glance_targets:
+            _TARGETS = [
+                GlanceClient(name, "glance:%s" % name) for name in CONF.glance_targets
+            ]
+        else:
+            _TARGETS = [GLANCE]
+    return _TARGETS
@@ -0,0 +1,100 @@
+"""Compute several digests of a stream in a single pass."""
+
+import hashlib
+import queue
+import sys
+import threading
+
+# Digests stored as imgsync.* properties. md5 and sha512 are also the ones
+# computed by Glance (checksum and the default os_hash_algo).
+ALGORITHMS = ("md5", "sha256", "sha512")
+
+BLOCK_SIZE = 2**20
+
+
+def new(name, data=b""):
+    """Get a hash object used for integrity checks, not for security.
+
+    :param name: name of the hashlib algorithm
+    :param data: initial data to hash
+    """
+    # usedforsecurity is only available in Python >= 3.9
+    if sys.version_info >= (3, 9):
+        return hashlib.new(name, data, usedforsecurity=False)
+    return hashlib.new(name, data)
+
+
+class MultiHasher(object):
+    """Hash object computing several digests in a worker thread.
+
+    Data passed to :meth:`update` is queued and hashed in a separate thread,
+    so hashing overlaps with the network and disk I/O done by the caller
+    (hashlib releases the GIL while hashing large buffers).
+    """
+
+    def __init__(self, algorithms=ALGORITHMS, maxsize=16):
+        """Initialize the hasher and start its worker thread.
+
+        :param algorithms: names of the hashlib algorithms to compute
+        :param maxsize: number of blocks to queue before blocking the caller
+        """
+        self._hashes = {name: new(name) for name in algorithms}
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._digests = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        data = self._queue.get()
+        while data is not None:
+            for h in self._hashes.values():
+                h.update(data)
+            data = self._queue.get()
+
+    def update(self, data):
+        """Queue some data to be hashed."""
+        if data:
+            self._queue.put(bytes(data))
+
+    def hexdigests(self):
+        """Wait for the queued data to be hashed and get the digests.
+
+        :returns: dict with the hex digest of each algorithm
+        """
+        if self._digests is None:
+            self._queue.put(None)
+            self._thread.join()
+            self._digests = {name: h.hexdigest() for name, h in self._hashes.items()}
+        return self._digests
+
+
+class HashingWriter(object):
+    """Writable file-like object that hashes the data written to it."""
+
+    def __init__(self, fd, hasher):
+        """Initialize the writer.
+
+        :param fd: file-like object where the data is written
+        :param hasher: hash object to update with the data
+        """
+        self._fd = fd
+        self._hasher = hasher
+
+    def write(self, data):
+        """Write and hash a block of data."""
+        self._hasher.update(data)
+        return self._fd.write(data)
+
+
+def file_digests(path, algorithms=ALGORITHMS, block_size=BLOCK_SIZE):
+    """Compute several digests of a file in a single read pass.
+
+    :returns: dict with the hex digest of each algorithm
+    """
+    hasher = MultiHasher(algorithms)
+    with open(path, "rb") as f:
+        buf = f.read(block_size)
+        while buf:
+            hasher.update(buf)
+            buf = f.read(block_size)
+    return hasher.hexdigests()
@@ -0,0 +1,183 @@
+"""Lock files to coordinate concurrent imgsync processes.
+
+A lock file is created (with O_EXCL, so only one process succeeds) for each
+image being synced into a Glance target, holding the pid and host of its owner
+and the time it was taken. Locks left behind by processes that died are
+considered stale and are broken.
+"""
+
+import json
+import os
+import re
+import socket
+import tempfile
+import time
+
+from oslo_config import cfg
+from oslo_log import log
+
+opts = [
+    cfg.StrOpt(
+        "lock_dir",
+        help="Directory where lock files are created so that concurrent "
+        "imgsync processes (e.g. overlapping cron runs) do not sync the same "
+        "image into the same Glance target twice. Use a shared directory if "
+        "imgsync runs in several hosts. If not set, a directory inside the "
+        "default temporary directory is used.",
+    ),
+    cfg.IntOpt(
+        "lock_wait",
+        default=0,
+        min=0,
+        help="Seconds to wait for an image that is being synced by another "
+        "process before skipping it. If the other process finishes in time, "
+        "the image is not synced again.",
+    ),
+    cfg.IntOpt(
+        "lock_timeout",
+        default=6 * 3600,
+        min=1,
+        help="Seconds after which a lock is considered stale and broken. Locks "
+        "of processes that are no longer running in the same host are broken "
+        "immediately.",
+    ),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
+LOG = log.getLogger(__name__)
+
+# Seconds between attempts to take a lock held by another process.
+POLL_INTERVAL = 5
+
+
+def _get_directory():
+    directory = CONF.lock_dir or os.path.join(tempfile.gettempdir(), "imgsync")
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Lock(object):
+    """A lock file shared between imgsync processes."""
+
+    def __init__(self, *key):
+        """Initialize the lock.
+
+        :param key: strings identifying what is locked (e.g. the Glance
+                    target and the image checksum)
+        """
+        name = re.sub(r"[^\w.-]", "_", "-".join(key))
+        self.path = os.path.join(_get_directory(), name + ".lock")
+        self.owner = None
+        self._info = None
+
+    def __str__(self):
+        """Get the path of the lock file."""
+        return self.path
+
+    def _read(self):
+        """Read the owner of the lock file, or None if it cannot be read."""
+        try:
+            with open(self.path) as f:
+                owner = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(owner, dict):
+            return None
+        return owner
+
+    def _is_stale(self, owner, mtime):
+        """Check if a lock belongs to a process that is gone."""
+        taken = (owner or {}).get("time", mtime)
+        if time.time() - taken > CONF.lock_timeout:
+            return True
+        pid = (owner or {}).get("pid")
+        if isinstance(pid, int) and owner.get("host") == socket.gethostname():
+            return not _pid_exists(pid)
+        return False
+
+    def _break(self, st):
+        """Remove a stale lock file, unless it has been replaced meanwhile."""
+        stale = "%s.%s.stale" % (self.path, os.getpid())
+        try:
+            os.rename(self.path, stale)
+        except FileNotFoundError:
+            return
+        # Another process may have broken the stale lock and taken it again
+        # after we checked it, so put it back if it is not the same file.
+        if os.stat(stale).st_ino != st.st_ino:
+            try:
+                os.link(stale, self.path)
+            except FileExistsError:
+                pass
+        os.remove(stale)
+
+    def _try_acquire(self):
+        """Try to take the lock once, breaking it if it is stale."""
+        for _ in range(2):
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                try:
+                    st = os.stat(self.path)
+                except FileNotFoundError:
+                    continue
+                self.owner = self._read()
+                if not self._is_stale(self.owner, st.st_mtime):
+                    return False
+                LOG.warning("Breaking stale lock %s (%s)", self.path, self.owner)
+                self._break(st)
+                continue
+
+            self._info = dict(
+                pid=os.getpid(), host=socket.gethostname(), time=time.time()
+            )
+            with os.fdopen(fd, "w") as f:
+                json.dump(self._info, f)
+            self.owner = None
+            return True
+        return False
+
+    def acquire(self, wait=None):
+        """Take the lock, waiting for it if it is held by another process.
+
+        :param wait: seconds to wait for the lock, lock_wait if None
+        :returns: True if the lock was taken, False otherwise
+        """
+        if wait is None:
+            wait = CONF.lock_wait
+        deadline = time.monotonic() + wait
+        while not self._try_acquire():
+            if time.monotonic() >= deadline:
+                return False
+            LOG.info("Waiting for lock %s held by %s", self.path, self.owner)
+            time.sleep(min(POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+        LOG.debug("Acquired lock %s", self.path)
+        return True
+
+    def release(self):
+        """Release the lock, if it is still ours."""
+        if self._info is None:
+            return
+        # If we ran for longer than lock_timeout the lock may have been broken
+        # and taken by another process, that must keep it.
+        if self._read() == self._info:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+        else:
+            LOG.warning("Lock %s was broken while we held it", self.path)
+        self._info = None
+        LOG.debug("Released lock %s", self.path)
@@ -0,0 +1,146 @@
+"""Export of verified images into a local mirror of the upstream repositories.
+
+The images are laid out as in the upstream repositories (e.g.
+``ubuntu/noble/current/``, or ``debian/bookworm/latest/`` and the dated
+``debian/bookworm/20240507-1740/`` build directory) together with regenerated
+checksum files, so that the mirror directory can be served with a plain web
+server and other imgsync instances can sync from it.
+"""
+
+import os
+import tempfile
+
+import dateutil.parser
+from oslo_config import cfg
+from oslo_log import log
+
+from imgsync import cache
+
+opts = [
+    cfg.StrOpt(
+        "mirror_dir",
+        help="Directory where the verified images are exported, reproducing "
+        "the layout of the upstream repositories together with their "
+        "SHA256SUMS and SHA512SUMS files. Images are hardlinked (or reflinked) "
+        "when possible instead of copied. Serve this directory with a web "
+        "server and point ubuntu_url and debian_url of other imgsync "
+        "instances to its ubuntu/ and debian/ directories. If not set, images "
+        "are not exported.",
+    ),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
+LOG = log.getLogger(__name__)
+
+# Checksum files regenerated in each mirrored directory.
+SUMS_FILES = {"sha256": "SHA256SUMS", "sha512": "SHA512SUMS"}
+
+
+def _get_path(distro, relpath):
+    return os.path.join(CONF.mirror_dir, distro, relpath)
+
+
+def _read_sums(path):
+    """Read a checksum file, returning a dict mapping file names to checksums."""
+    sums = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2:
+                    sums[fields[1].lstrip("*")] = fields[0]
+    except FileNotFoundError:
+        pass
+    return sums
+
+
+def _write_sums(path, sums, binary=False, mtime=None):
+    """Atomically write a checksum file."""
+    fmt = "%s *%s\n" if binary else "%s  %s\n"
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".", suffix=".imgsync")
+    try:
+        with os.fdopen(fd, "w") as f:
+            for filename, checksum in sorted(sums.items()):
+                f.write(fmt % (checksum, filename))
+        os.chmod(tmp, 0o644)
+        if mtime is not None:
+            os.utime(tmp, (mtime, mtime))
+        os.replace(tmp, path)
+    except OSError:
+        os.remove(tmp)
+        raise
+
+
+def needs_export(distro, relpath, checksum_type, checksum):
+    """Check if an image has to be exported into the mirror.
+
+    :param distro: distribution family, mirrored in a directory of its own
+    :param relpath: path of the image relative to the upstream base url
+    :param checksum_type: algorithm of the checksum (e.g. "sha256")
+    :param checksum: expected checksum of the image
+    :returns: False if there is no mirror or the image is already exported
+    """
+    if not CONF.mirror_dir or relpath is None:
+        return False
+    path = _get_path(distro, relpath)
+    if not os.path.isfile(path):
+        return True
+    directory, filename = os.path.split(path)
+    sums = _read_sums(os.path.join(directory, SUMS_FILES[checksum_type]))
+    return sums.get(filename) != checksum
+
+
+def export(path, distro, relpath, checksums, binary=False, last_modified=None):
+    """Export a verified image into the mirror.
+
+    The modification time of the image and the checksum files is set to the
+    one of the upstream checksum files, as the Last-Modified header served for
+    them is used as the image revision.
+
+    :param path: path of the verified image
+    :param distro: distribution family, mirrored in a directory of its own
+    :param relpath: path of the image relative to the upstream base url
+    :param checksums: dict with the digests of the image
+    :param binary: whether files are marked as binary ("*name") in the
+                   checksum files, as upstream does
+    :param last_modified: Last-Modified header of the upstream checksum files
+    :returns: the directory where the image was exported, or None
+    """
+    if not CONF.mirror_dir or relpath is None:
+        return None
+
+    mtime = None
+    if last_modified:
+        mtime = dateutil.parser.parse(last_modified).timestamp()
+
+    directory, filename = os.path.split(_get_path(distro, relpath))
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".", suffix=".imgsync")
+    os.close(fd)
+    os.remove(tmp)
+    try:
+        cache.link_or_copy(path, tmp)
+        os.chmod(tmp, 0o644)
+        if mtime is not None:
+            os.utime(tmp, (mtime, mtime))
+        os.replace(tmp, os.path.join(directory, filename))
+
+        # The image is in place before it is listed in the checksum files, so
+        # that downstream instances never see a checksum without its image.
+        for algorithm, sums_file in SUMS_FILES.items():
+            sums_path = os.path.join(directory, sums_file)
+            sums = _read_sums(sums_path)
+            sums[filename] = checksums[algorithm]
+            _write_sums(sums_path, sums, binary=binary, mtime=mtime)
+    except OSError as e:
+        LOG.warning("Cannot export %s to the mirror: %s", filename, e)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return None
+
+    LOG.info("Exported %s into %s", filename, directory)
+    return directory
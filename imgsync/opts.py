@@ -14,16 +14,31 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import imgsync.cache
+import imgsync.delta
 import imgsync.distros
-import imgsync.distros.centos
+import imgsync.distros.debian
+import imgsync.distros.ubuntu
 import imgsync.glance
+import imgsync.lock
+import imgsync.mirror
+import imgsync.staging
 
 
 def list_opts():
     """Return a list of oslo_config options available in imgsync."""
     return [
-        ("DEFAULT", imgsync.distros.opts),
-        ("centos6", imgsync.distros.centos.c6_opts),
-        ("centos7", imgsync.distros.centos.c7_opts),
-        ("keystone_auth", imgsync.glance.opts),
+        (
+            "DEFAULT",
+            imgsync.distros.opts
+            + imgsync.glance.target_opts
+            + imgsync.cache.opts
+            + imgsync.delta.opts
+            + imgsync.staging.opts
+            + imgsync.mirror.opts
+            + imgsync.lock.opts
+            + imgsync.distros.ubuntu.opts
+            + imgsync.distros.debian.opts,
+        ),
+        ("keystone_auth", imgsync.glance.opts + imgsync.glance.store_opts),
     ]
@@ -0,0 +1,236 @@
+"""Profiling of imgsync runs."""
+
+import collections
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+from oslo_config import cfg
+from oslo_log import log
+
+cli_opts = [
+    cfg.BoolOpt(
+        "profile",
+        default=False,
+        help="Profile the run (CPU with cProfile, memory with tracemalloc and "
+        "I/O counters), writing the profile artifacts and a summary per phase "
+        "and per distribution into --profile-dir.",
+    ),
+    cfg.StrOpt(
+        "profile-dir",
+        default=".",
+        help="Directory where the profile artifacts of each run are written.",
+    ),
+]
+
+CONF = cfg.CONF
+CONF.register_cli_opts(cli_opts)
+
+LOG = log.getLogger(__name__)
+
+# Number of entries shown in each section of the summary.
+TOP = 20
+
+_PHASES = []
+_PROFILERS = []
+_LOCK = threading.Lock()
+_LOCAL = threading.local()
+
+
+def _read_io():
+    """Get the I/O counters of the process (Linux only)."""
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+@contextlib.contextmanager
+def phase(name, distro=None):
+    """Record the resources used by a phase of the run.
+
+    Nothing is recorded unless profiling is enabled. Phases nested in another
+    one inherit its distribution, if none is given.
+
+    :param name: name of the phase (e.g. "download")
+    :param distro: name of the distribution being processed
+    """
+    if not CONF.profile:
+        yield
+        return
+
+    stack = getattr(_LOCAL, "distros", None)
+    if stack is None:
+        stack = _LOCAL.distros = []
+    if distro is None and stack:
+        distro = stack[-1]
+    stack.append(distro)
+
+    io_start = _read_io()
+    mem_start = tracemalloc.get_traced_memory()[0]
+    cpu_start = time.thread_time()
+    wall_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.thread_time() - cpu_start
+        mem, peak = tracemalloc.get_traced_memory()
+        io_end = _read_io()
+        stack.pop()
+        with _LOCK:
+            _PHASES.append(
+                {
+                    "phase": name,
+                    "distro": distro,
+                    "wall": wall,
+                    "cpu": cpu,
+                    "memory": mem - mem_start,
+                    "peak_memory": peak,
+                    "read_bytes": io_end.get("rchar", 0) - io_start.get("rchar", 0),
+                    "write_bytes": io_end.get("wchar", 0) - io_start.get("wchar", 0),
+                }
+            )
+
+
+def _profile_thread(frame, event, arg):
+    """Start profiling a new thread with a profiler of its own.
+
+    This is set with threading.setprofile(), so that it is called once by each
+    thread started while profiling. Enabling the profiler replaces it.
+    """
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Since Python 3.12 the profiler of the main thread already covers all
+        # the threads, and only one can be active.
+        return
+    with _LOCK:
+        _PROFILERS.append(profiler)
+
+
+def _merge_stats(profiler):
+    """Merge the stats of the main thread and of the threads it started."""
+    stats = pstats.Stats(profiler)
+    with _LOCK:
+        for thread_profiler in _PROFILERS:
+            stats.add(thread_profiler)
+        del _PROFILERS[:]
+    return stats
+
+
+def _summarize_phases():
+    """Aggregate the recorded phases per distribution and phase."""
+    totals = collections.OrderedDict()
+    for record in _PHASES:
+        key = (record["distro"] or "-", record["phase"])
+        total = totals.setdefault(
+            key,
+            {"count": 0, "wall": 0, "cpu": 0, "memory": 0, "read": 0, "write": 0},
+        )
+        total["count"] += 1
+        total["wall"] += record["wall"]
+        total["cpu"] += record["cpu"]
+        total["memory"] = max(total["memory"], record["memory"])
+        total["read"] += record["read_bytes"]
+        total["write"] += record["write_bytes"]
+    return totals
+
+
+def _write_summary(path, stats, snapshot):
+    """Write a short human readable summary of the profile."""
+    with open(path, "w") as f:
+        f.write("== Phases (per distribution) ==\n")
+        f.write(
+            "I/O counters are process wide, and CPU time is the one of the "
+            "thread running the phase.\n\n"
+        )
+        f.write(
+            "%-16s %-10s %5s %10s %10s %12s %14s %14s\n"
+            % (
+                "distro",
+                "phase",
+                "count",
+                "wall (s)",
+                "cpu (s)",
+                "mem (KiB)",
+                "read (B)",
+                "write (B)",
+            )
+        )
+        for (distro, name), total in _summarize_phases().items():
+            f.write(
+                "%-16s %-10s %5d %10.2f %10.2f %12d %14d %14d\n"
+                % (
+                    distro,
+                    name,
+                    total["count"],
+                    total["wall"],
+                    total["cpu"],
+                    total["memory"] // 1024,
+                    total["read"],
+                    total["write"],
+                )
+            )
+
+        for sort in ("cumulative", "tottime"):
+            f.write("\n== Top %s functions by %s (all threads) ==\n" % (TOP, sort))
+            stats.stream = io.StringIO()
+            stats.sort_stats(sort).print_stats(TOP)
+            f.write(stats.stream.getvalue())
+
+        f.write("\n== Top %s memory allocation sites ==\n" % TOP)
+        for stat in snapshot.statistics("lineno")[:TOP]:
+            f.write("%s\n" % stat)
+
+
+def run(func):
+    """Run a function profiling it, and write the profile artifacts.
+
+    The following files are written into a new directory for the run inside
+    --profile-dir: "imgsync.prof" (cProfile stats of all the threads, that can
+    be loaded with pstats or snakeviz), "phases.json" (resources used by each
+    phase) and "summary.txt" (top functions, phases and memory allocation
+    sites).
+
+    :param func: function to run
+    :returns: whatever the function returns
+    """
+    directory = os.path.join(
+        CONF.profile_dir, "imgsync-profile-%s" % time.strftime("%Y%m%d-%H%M%S")
+    )
+    os.makedirs(directory, exist_ok=True)
+
+    del _PHASES[:]
+    tracemalloc.start(10)
+    profiler = cProfile.Profile()
+    threading.setprofile(_profile_thread)
+    profiler.enable()
+    try:
+        with phase("total"):
+            return func()
+    finally:
+        profiler.disable()
+        threading.setprofile(None)
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        stats = _merge_stats(profiler)
+        stats.dump_stats(os.path.join(directory, "imgsync.prof"))
+        with open(os.path.join(directory, "phases.json"), "w") as f:
+            json.dump(_PHASES, f, indent=4)
+        _write_summary(os.path.join(directory, "summary.txt"), stats, snapshot)
+        print("Profile written to %s" % directory, file=sys.stderr)
@@ -0,0 +1,204 @@
+"""Staging area where images are downloaded before being uploaded."""
+
+import contextlib
+import os
+import queue
+import tempfile
+import threading
+
+from oslo_config import cfg
+from oslo_log import log
+
+opts = [
+    cfg.StrOpt(
+        "staging_dir",
+        help="Directory where images are downloaded before being uploaded to "
+        "Glance. If not set, the default temporary directory is used.",
+    ),
+    cfg.IntOpt(
+        "staging_min_free",
+        default=1024,
+        min=0,
+        help="Free space, in MiB, that must be left in the staging directory. "
+        "Downloads that do not fit are queued until other downloads finish. "
+        "If an image does not fit even when nothing else is staged, it is "
+        "streamed directly to Glance without being staged.",
+    ),
+    cfg.IntOpt(
+        "staging_unknown_size",
+        default=4096,
+        min=0,
+        help="Space, in MiB, reserved in the staging directory for downloads "
+        "whose size is not known in advance (e.g. the upstream server does not "
+        "send a Content-Length header).",
+    ),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
+LOG = log.getLogger(__name__)
+
+
+class StagingArea(object):
+    """Admission control for the space used in the staging directory.
+
+    Space is reserved before each download starts and released once the staged
+    file is removed, so that concurrent downloads never fill the filesystem.
+    """
+
+    def __init__(self):
+        """Initialize the staging area."""
+        self._cond = threading.Condition()
+        self._reserved = 0
+
+    @property
+    def directory(self):
+        """Get the staging directory, creating it if needed."""
+        directory = CONF.staging_dir or tempfile.gettempdir()
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def available(self):
+        """Get the space that can be used for new downloads, in bytes."""
+        st = os.statvfs(self.directory)
+        free = st.f_bavail * st.f_frsize - CONF.staging_min_free * 2**20
+        # Files being downloaded are accounted twice (as reserved and as used
+        # space), so this is a conservative estimation.
+        return free - self._reserved
+
+    @contextlib.contextmanager
+    def reserve(self, size, name=None):
+        """Reserve space in the staging area while the context is active.
+
+        Waits until there is enough space available if other reservations
+        are active.
+
+        :param size: bytes to reserve, None if the size is unknown
+        :param name: name of what is being staged, for logging
+        :returns: True if the space was reserved, False if it does not fit
+                  even without other reservations, so the caller has to
+                  stream the data instead of staging it.
+        """
+        if not size:
+            size = CONF.staging_unknown_size * 2**20
+            LOG.warning(
+                "Size of %s is unknown, reserving %s bytes of staging space",
+                name,
+                size,
+            )
+        with self._cond:
+            while size > self.available() and self._reserved:
+                LOG.info("Not enough staging space for %s, queuing download", name)
+                self._cond.wait()
+            admitted = size <= self.available()
+            if admitted:
+                self._reserved += size
+
+        if not admitted:
+            LOG.warning(
+                "Not enough space in %s to stage %s (%s bytes)",
+                self.directory,
+                name,
+                size,
+            )
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            with self._cond:
+                self._reserved -= size
+                self._cond.notify_all()
+
+
+STAGING = StagingArea()
+
+
+class StreamClosed(Exception):
+    """The consumer of a stream has gone away."""
+
+
+class QueueReader(object):
+    """File-like object reading the blocks written into a Fanout."""
+
+    def __init__(self, maxsize=16):
+        """Initialize the reader.
+
+        :param maxsize: number of blocks to buffer before blocking the writer
+        """
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._buffer = b""
+        self._eof = False
+        self._error = None
+        self.closed = False
+
+    def put(self, data):
+        """Put a block of data, blocking while the buffer is full."""
+        while not self.closed:
+            try:
+                self._queue.put(data, timeout=1)
+                return
+            except queue.Full:
+                pass
+        raise StreamClosed()
+
+    def read(self, size=-1):
+        """Read up to size bytes, blocking until they are available."""
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                self._error = item
+                self._eof = True
+            elif item is None:
+                self._eof = True
+            else:
+                self._buffer += item
+
+        if self._error is not None and not self._buffer:
+            raise self._error
+
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        """Close the reader, the writer will not block on it anymore."""
+        self.closed = True
+
+
+class Fanout(object):
+    """Writable file-like object that copies data into several readers.
+
+    Readers that have been closed (e.g. because their upload failed) are
+    skipped, so that one failing consumer does not stop the others.
+    """
+
+    def __init__(self, readers):
+        """Initialize the fanout with the readers to feed."""
+        self._readers = list(readers)
+        self.bytes_written = 0
+
+    def write(self, data):
+        """Write a block of data to all the readers."""
+        if not data:
+            return
+        for reader in self._readers:
+            if reader.closed:
+                continue
+            try:
+                reader.put(data)
+            except StreamClosed:
+                pass
+        self.bytes_written += len(data)
+
+    def close(self, error=None):
+        """Signal the end of the stream (or an error) to all the readers."""
+        for reader in self._readers:
+            if not reader.closed:
+                try:
+                    reader.put(error)
+                except StreamClosed:
+                    pass
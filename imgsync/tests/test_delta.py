@@ -0,0 +1,221 @@
+"""Tests for the zsync based delta updates."""
+
+import os
+import random
+import shutil
+import subprocess  # nosec B404
+import tempfile
+import unittest
+from unittest import mock
+
+import requests
+
+from imgsync import delta
+from imgsync import exception
+
+BLOCKSIZE = 2048
+
+
+def _reference_rsum(block):
+    """Weak checksum as computed by rcksum_calc_rsum_block() in zsync."""
+    a = b = 0
+    length = len(block)
+    for c in block:
+        a = (a + c) & 0xFFFF
+        b = (b + length * c) & 0xFFFF
+        length -= 1
+    return (a << 16) | b
+
+
+def _make_control(data, blocksize=BLOCKSIZE, rsum_bytes=4, checksum_bytes=16):
+    """Build a zsync control file for some data, as zsyncmake does."""
+    header = (
+        "zsync: 0.6.2\n"
+        "Filename: image.img\n"
+        "Blocksize: %s\n"
+        "Length: %s\n"
+        "Hash-Lengths: 1,%s,%s\n"
+        "URL: image.img\n\n" % (blocksize, len(data), rsum_bytes, checksum_bytes)
+    )
+    body = b""
+    for offset in range(0, len(data), blocksize):
+        end = offset + blocksize
+        block = data[offset:end].ljust(blocksize, b"\x00")
+        rsum = _reference_rsum(block).to_bytes(4, "big")
+        body += rsum[-rsum_bytes:]
+        if checksum_bytes:
+            body += delta.md4(block)[:checksum_bytes]
+    return header.encode("utf-8") + body
+
+
+class TestControlFile(unittest.TestCase):
+    """Tests for the zsync control file parser."""
+
+    def test_parse(self):
+        """Parse the headers and the block checksums."""
+        body = b"\x00\x01" + b"A" * 3 + b"\x00\x02" + b"B" * 3
+        data = b"zsync: 0.6.2\nBlocksize: 4\nLength: 6\nHash-Lengths: 2,2,3\n\n" + body
+        control = delta.ControlFile(data)
+        self.assertEqual(4, control.blocksize)
+        self.assertEqual(6, control.length)
+        self.assertEqual(2, control.seq_matches)
+        self.assertEqual(0xFFFF, control.rsum_mask)
+        self.assertEqual([(1, b"AAA"), (2, b"BBB")], control.blocks)
+
+    def test_truncated(self):
+        """Fail if there are less checksums than blocks."""
+        data = b"Blocksize: 4\nLength: 6\nHash-Lengths: 2,2,3\n\n" + b"\x00" * 5
+        self.assertRaises(exception.DeltaSyncFailed, delta.ControlFile, data)
+
+    def test_missing_header(self):
+        """Fail if a mandatory header is missing."""
+        data = b"Blocksize: 4\nHash-Lengths: 2,2,3\n\n"
+        self.assertRaises(exception.DeltaSyncFailed, delta.ControlFile, data)
+
+
+class TestRsum(unittest.TestCase):
+    """Tests for the zsync weak checksum."""
+
+    def test_small(self):
+        """Check a checksum computed by hand."""
+        # a = 1 + 2 + 3, b = 3 * 1 + 2 * 2 + 1 * 3
+        self.assertEqual((6 << 16) | 10, delta.rsum(b"\x01\x02\x03"))
+
+    def test_reference(self):
+        """Check against the zsync algorithm, including overflows."""
+        rnd = random.Random(0)  # nosec B311
+        for block in (b"\xff" * BLOCKSIZE, rnd.randbytes(BLOCKSIZE)):
+            self.assertEqual(_reference_rsum(block), delta.rsum(block))
+
+
+@unittest.skipUnless(delta.MD4_AVAILABLE, "MD4 not available in hashlib")
+class TestMD4(unittest.TestCase):
+    """Tests for the zsync strong checksum, with the RFC 1320 test suite."""
+
+    def test_vectors(self):
+        """Check the RFC 1320 test vectors."""
+        vectors = {
+            b"": "31d6cfe0d16ae931b73c59d7e0c089c0",
+            b"a": "bde52cb31de33e46245e05fbdbd6fb24",
+            b"abc": "a448017aaf21d8525fc10ae87aa6729d",
+            b"message digest": "d9130a8164549fe818874806e1c7014b",
+        }
+        for data, digest in vectors.items():
+            self.assertEqual(digest, delta.md4(data).hex())
+
+
+@unittest.skipUnless(shutil.which("zsyncmake"), "zsyncmake not available")
+class TestZsyncmake(unittest.TestCase):
+    """Tests against control files generated by zsyncmake."""
+
+    def setUp(self):
+        """Create a temporary directory."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_control_file(self):
+        """Parse a control file and check its block checksums."""
+        rnd = random.Random(0)  # nosec B311
+        data = rnd.randbytes(BLOCKSIZE * 20 + 123)
+        path = os.path.join(self.tmpdir, "image.img")
+        with open(path, "wb") as f:
+            f.write(data)
+
+        control_path = path + ".zsync"
+        subprocess.run(  # nosec B603 B607
+            ["zsyncmake", "-Z", "-b", str(BLOCKSIZE), "-o", control_path, path],
+            cwd=self.tmpdir,
+            check=True,
+            capture_output=True,
+        )
+        with open(control_path, "rb") as f:
+            control = delta.ControlFile(f.read())
+
+        self.assertEqual(BLOCKSIZE, control.blocksize)
+        self.assertEqual(len(data), control.length)
+        self.assertEqual(21, len(control.blocks))
+        for i, (rsum, strong) in enumerate(control.blocks):
+            start = i * BLOCKSIZE
+            end = start + BLOCKSIZE
+            block = data[start:end].ljust(BLOCKSIZE, b"\x00")
+            self.assertEqual(delta.rsum(block) & control.rsum_mask, rsum)
+            if delta.MD4_AVAILABLE:
+                self.assertEqual(delta.md4(block)[: control.checksum_bytes], strong)
+
+
+class FakeResponse(object):
+    """A streamed HTTP response serving part of some data."""
+
+    def __init__(self, content, status_code=200, error=None):
+        """Initialize the response, that fails with error after the data."""
+        self.content = content
+        self.status_code = status_code
+        self.error = error
+
+    def iter_content(self, size):
+        """Iterate over the content in blocks."""
+        for offset in range(0, len(self.content), size):
+            end = offset + size
+            yield self.content[offset:end]
+        if self.error:
+            raise self.error
+
+
+class TestFetch(unittest.TestCase):
+    """Tests for the delta download."""
+
+    def setUp(self):
+        """Create an old revision and a new one with a changed block."""
+        rnd = random.Random(0)  # nosec B311
+        self.old = rnd.randbytes(BLOCKSIZE * 64)
+        changed, unchanged = BLOCKSIZE * 10, BLOCKSIZE * 11
+        self.new = self.old[:changed] + rnd.randbytes(BLOCKSIZE)
+        self.new += self.old[unchanged:] + b"tail"
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.old_path = os.path.join(self.tmpdir, "old.img")
+        with open(self.old_path, "wb") as f:
+            f.write(self.old)
+
+    def _session(self, control, error=None):
+        def get(url, headers=None, **kwargs):
+            if url.endswith(".zsync"):
+                return FakeResponse(control)
+            first, last = headers["Range"].replace("bytes=", "").split("-")
+            start, end = int(first), int(last) + 1
+            return FakeResponse(self.new[start:end], 206, error)
+
+        session = mock.Mock()
+        session.get.side_effect = get
+        return session
+
+    @unittest.skipUnless(delta.MD4_AVAILABLE, "MD4 not available in hashlib")
+    def test_fetch(self):
+        """Rebuild the new file downloading only the changed blocks."""
+        session = self._session(_make_control(self.new))
+        with mock.patch("requests.Session", return_value=session):
+            with open(os.path.join(self.tmpdir, "new.img"), "w+b") as location:
+                downloaded = delta.fetch("url", "url.zsync", self.old_path, location)
+                location.seek(0)
+                self.assertEqual(self.new, location.read())
+        # Only the changed block and the last (partial) block are downloaded
+        self.assertEqual(BLOCKSIZE + len(b"tail"), downloaded)
+
+    def test_fetch_connection_error(self):
+        """Fail with DeltaSyncFailed if the connection drops."""
+        # No block of the old file matches, so MD4 is never computed
+        control = _make_control(b"\x00" * BLOCKSIZE * 4, checksum_bytes=0)
+        error = requests.exceptions.ChunkedEncodingError("connection dropped")
+        session = self._session(control, error)
+        with mock.patch("requests.Session", return_value=session):
+            with mock.patch.object(delta, "MD4_AVAILABLE", True):
+                with open(os.path.join(self.tmpdir, "new.img"), "w+b") as location:
+                    self.assertRaises(
+                        exception.DeltaSyncFailed,
+                        delta.fetch,
+                        "url",
+                        "url.zsync",
+                        self.old_path,
+                        location,
+                    )